@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 import pymongo
+from twisted.internet import task
+from scrapy import log
 from ui.mongoutils.memex_mongo_utils import MemexMongoUtils
 
 class MongoPipeline(object):
@@ -31,22 +33,85 @@ class MongoPipeline(object):
         return item
 
 class SourcePinPipeline(object):
+    """ Scrapy item pipeline that stores pages with MemexMongoUtils.
 
-    def __init__(self, mongo_uri):
+    With SOURCEPIN_BUFFER_SIZE set items are buffered and written with
+    MemexMongoUtils.insert_urls once the buffer is full, every
+    SOURCEPIN_FLUSH_INTERVAL seconds and when the spider closes. A batch
+    that fails is retried with the next flush, after SOURCEPIN_FLUSH_RETRIES
+    failed flushes its items are stored one by one and the ones that still
+    fail are logged and dropped.
+
+    Without a buffer items are stored one at a time with insert_url, which
+    throttles the change counter bumps. The ones it held back are counted
+    every SOURCEPIN_FLUSH_INTERVAL seconds and when the spider closes.
+    """
+
+    def __init__(self, mongo_uri, buffer_size=0, flush_interval=5.0, flush_retries=3):
         self.mongo_uri = mongo_uri
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.flush_retries = flush_retries
+        self.failed_flushes = 0
+        self.buffer = []
+        self.flush_task = None
 
     @classmethod
     def from_crawler(cls, crawler):
         return cls(
             mongo_uri=crawler.settings.get('MONGO_URI'),
+            buffer_size=crawler.settings.getint('SOURCEPIN_BUFFER_SIZE', 0),
+            flush_interval=crawler.settings.getfloat('SOURCEPIN_FLUSH_INTERVAL', 5.0),
+            flush_retries=crawler.settings.getint('SOURCEPIN_FLUSH_RETRIES', 3),
         )
 
     def open_spider(self, spider):
         self.mongo_address, self.mongo_port = self.mongo_uri.split(":")
         self.mmu = MemexMongoUtils(address = self.mongo_address, port = int(self.mongo_port))
 
+        if self.flush_interval > 0:
+            self.flush_task = task.LoopingCall(self.flush)
+            self.flush_task.start(self.flush_interval, now=False)
+
     def close_spider(self, spider):
-        pass
+        if self.flush_task is not None and self.flush_task.running:
+            self.flush_task.stop()
+        self.flush()
+
+    def flush(self):
+        self.mmu.flush_changes()
+        if not self.buffer:
+            return
+        items, self.buffer = self.buffer, []
+        try:
+            self.mmu.insert_urls(items)
+            self.failed_flushes = 0
+        except Exception:
+            # raising would stop the LoopingCall. insert_urls finishes the urls a failed attempt
+            # stored when they come around again.
+            self.failed_flushes += 1
+            if self.failed_flushes < self.flush_retries:
+                self.buffer[:0] = items
+                log.err(None, "Failed to store %d items (attempt %d), keeping them for the next flush" % (len(items), self.failed_flushes))
+            else:
+                self.failed_flushes = 0
+                self.store_one_by_one(items)
+
+    def store_one_by_one(self, items):
+        """Last attempt for items whose batch keeps failing, so one bad item can't hold back the rest"""
+
+        for item in items:
+            try:
+                self.mmu.insert_urls([item])
+            except Exception:
+                log.err(None, "Failed to store %s, dropping it" % item.get("url"))
 
     def process_item(self, item, spider):
-        self.mmu.insert_url(**dict(item))
\ No newline at end of file
+        if not self.buffer_size:
+            self.mmu.insert_url(**dict(item))
+            return item
+
+        self.buffer.append(dict(item))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+        return item
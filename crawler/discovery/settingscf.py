@@ -34,6 +34,9 @@ MONGO_DATABASE = 'MemexHack'
 ITEM_PIPELINES = {
     'discovery.pipelines.SourcePinPipeline': 100,
 }
+SOURCEPIN_BUFFER_SIZE = 200  # items written per bulk flush, 0 writes every item as it comes
+SOURCEPIN_FLUSH_INTERVAL = 5  # seconds, flush a partially filled buffer at least this often
+SOURCEPIN_FLUSH_RETRIES = 3  # failed flushes of a batch before its items are stored one by one
 
 HTTPCACHE_ENABLED = True
 
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of html.tree2text against the clean/tostring/reparse path it replaced.
+
+    python bench_html.py [page.html ...]
+
+Without files it runs on the first 200 pages stored in the selected workspace.
+"""
+import sys
+import time
+import itertools
+import lxml.html
+import lxml.html.clean
+from html import prepare_html
+
+REPEAT = 3
+
+
+def roundtrip_text(html):
+    """The previous extraction, cleaning then serializing and parsing the page a second time"""
+
+    cleaner = lxml.html.clean.Cleaner(
+        style=True,
+        scripts=True,
+        javascript=True,
+        comments=True,
+        embedded=True,
+        forms=False,
+        page_structure=False,
+    )
+    tree = cleaner.clean_html(lxml.html.fromstring(html))
+    doc = lxml.html.document_fromstring(lxml.html.tostring(tree))
+    return ' '.join(doc.text_content().split())
+
+
+def load_pages(fns, limit=200):
+    if fns:
+        pages = []
+        for fn in fns:
+            with open(fn, 'rb') as f:
+                pages.append(f.read())
+        return pages
+
+    # only needed without files, so pages on disk can be benchmarked without a database
+    from ui.mongoutils.memex_mongo_utils import MemexMongoUtils
+    from ui.utils.compression import decompress_html
+
+    mmu = MemexMongoUtils()
+    docs = itertools.islice(mmu.iter_urls(fields=["url", "html", "html_rendered"], return_html=True), limit)
+    pages = [decompress_html(doc.get('html_rendered', doc.get('html'))) for doc in docs]
+    return [page.encode('utf8') for page in pages if page]
+
+
+def bench(extract, pages):
+    best = None
+    for _ in range(REPEAT):
+        started = time.time()
+        for page in pages:
+            extract(page)
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(fns):
+    pages = load_pages(fns)
+    if not pages:
+        print "No pages to run on"
+        return
+
+    mismatches = sum(1 for page in pages if roundtrip_text(page) != prepare_html(page))
+    old = bench(roundtrip_text, pages)
+    new = bench(prepare_html, pages)
+
+    print "%d pages, %d KB, best of %d" % (len(pages), sum(len(page) for page in pages) // 1024, REPEAT)
+    print "clean/tostring/reparse: %.3fs (%.1f pages/s)" % (old, len(pages) / old)
+    print "single pass tree2text:  %.3fs (%.1f pages/s)" % (new, len(pages) / new)
+    print "speedup: %.2fx, pages with different text: %d" % (old / new, mismatches)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Text extraction in a pool of worker processes.
+
+Parsing and cleaning html is CPU bound, extract_texts spreads it over EXTRACT_WORKERS
+processes while keeping a bounded number of chunks in flight, so a mongo cursor can be
+streamed through it without loading every body into memory.
+
+Extracted texts are stored with the page bodies (MemexMongoUtils.save_texts) and reused
+by iter_texts until the body changes, so a page is only parsed once.
+"""
+import os
+import time
+import multiprocessing
+from collections import deque
+from html import prepare_mongodoc, TEXT_VERSION
+
+# Extraction worker processes, RANKER_EXTRACT_WORKERS overrides one per CPU
+EXTRACT_WORKERS = int(os.environ.get("RANKER_EXTRACT_WORKERS", 0)) or multiprocessing.cpu_count()
+
+
+def _extract_chunk(prepare, docs):
+    texts = []
+    for doc in docs:
+        try:
+            texts.append(prepare(doc))
+        except Exception:
+            texts.append(None)
+    return texts
+
+
+def chunks(docs, size):
+    """Lists of size docs at a time, the last one possibly shorter"""
+
+    chunk = []
+    for doc in docs:
+        chunk.append(doc)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def extract_texts(docs, prepare, workers=None, chunk_size=20, max_pending=None, stats=None):
+    """Yield (doc, text) for docs in order, text being prepare(doc) or None if that failed.
+    prepare runs in the workers, it has to be a module level function.
+
+    At most max_pending chunks (2 per worker by default) are read ahead of the consumer.
+    stats, if given, is kept up to date with the extracted count, seconds and docs per second.
+    """
+
+    workers = workers or EXTRACT_WORKERS
+    max_pending = max_pending or 2 * workers
+    stats = stats if stats is not None else {}
+    stats.update(extracted=0, seconds=0.0, per_second=0.0, workers=workers)
+    started = time.time()
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = deque()
+        doc_chunks = chunks(docs, chunk_size)
+        while True:
+            while len(pending) < max_pending:
+                chunk = next(doc_chunks, None)
+                if chunk is None:
+                    break
+                pending.append((chunk, pool.apply_async(_extract_chunk, (prepare, chunk))))
+            if not pending:
+                break
+
+            chunk, result = pending.popleft()
+            for doc, text in zip(chunk, result.get()):
+                yield doc, text
+
+            stats["extracted"] += len(chunk)
+            stats["seconds"] = time.time() - started
+            stats["per_second"] = stats["extracted"] / stats["seconds"] if stats["seconds"] else 0.0
+    finally:
+        pool.terminate()
+        pool.join()
+
+    print "Extracted %d docs in %.1fs (%.1f docs/s) with %d workers" % (stats["extracted"], stats["seconds"], stats["per_second"], workers)
+
+
+def prepare_stored(doc):
+    """Text stored for doc if attach_texts found a current one, else extracted from its body"""
+
+    if "text" in doc:
+        return doc["text"]
+    return prepare_mongodoc(doc)
+
+
+def with_texts(mmu, docs, batch_size=200):
+    """Url documents with their stored text attached where it is current, the body otherwise"""
+
+    for batch in chunks(docs, batch_size):
+        mmu.attach_texts(batch, TEXT_VERSION)
+        mmu.attach_content([doc for doc in batch if "text" not in doc])
+        for doc in batch:
+            yield doc
+
+
+def iter_texts(mmu, docs, workers=None, batch_size=200, stats=None):
+    """Yield (doc, text) for url documents that went through with_texts (or attach_texts and
+    attach_content), extracting the missing texts in the pool and storing them batch_size at a time.
+    """
+
+    extracted = []
+    for doc, text in extract_texts(docs, prepare_stored, workers=workers, stats=stats):
+        if "text" not in doc and text is not None:
+            extracted.append((doc, text))
+            if len(extracted) == batch_size:
+                mmu.save_texts(extracted, TEXT_VERSION)
+                extracted = []
+        yield doc, text
+
+    mmu.save_texts(extracted, TEXT_VERSION)
@@ -1,25 +1,48 @@
 # -*- coding: utf-8 -*-
+"""
+Page text for the ranker.
+
+tree2text parses a page once and walks the tree once, leaving out the elements lxml's Cleaner
+used to kill before the text was read. Cleaning a tree, serializing it and parsing it again gave
+the same text at two parses a page, bench_html.py compares the two.
+"""
 from __future__ import absolute_import
 import lxml.html
-import lxml.html.clean
+from ui.utils.compression import decompress_html
 
+# Elements whose text isn't page text: the kill_tags of the Cleaner this replaced (style, scripts,
+# embedded and its default links, meta and frames). Their tails are page text, as with Cleaner.
+SKIP_TAGS = frozenset(["script", "style", "link", "meta", "applet", "frameset", "frame", "noframes"])
 
-cleaner = lxml.html.clean.Cleaner(
-    style=True,
-    scripts=True,
-    javascript=True,
-    comments=True,
-    embedded=True,
-    forms=True,
-    page_structure=False,
-)
+# Stored texts are reused only when extracted by this version, bump it whenever the text changes
+TEXT_VERSION = 1
 
 
 def tree2text(tree):
-    tree = cleaner.clean_html(tree)
-    html = lxml.html.tostring(tree)
-    doc = lxml.html.document_fromstring(html)
-    return ' '.join(doc.text_content().split())
+    """Whitespace normalized text of an lxml tree or element, in document order"""
+
+    if hasattr(tree, "getroot"):
+        tree = tree.getroot()
+
+    parts = []
+    # elements still to walk and tail texts still to add, children come off the stack in document order
+    stack = [tree]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, basestring):
+            parts.append(item)
+            continue
+
+        # comments and processing instructions have a factory function as tag, skip them like SKIP_TAGS
+        if isinstance(item.tag, basestring) and item.tag.lower() not in SKIP_TAGS:
+            if item.text:
+                parts.append(item.text)
+            for child in reversed(item):
+                if child.tail:
+                    stack.append(child.tail)
+                stack.append(child)
+
+    return ' '.join(''.join(parts).split())
 
 
 def prepare_html(html):
@@ -28,7 +51,7 @@ def prepare_html(html):
 
 
 def prepare_mongodoc(doc):
-    html = doc.get('html_rendered', doc.get('html')) or ''
+    html = decompress_html(doc.get('html_rendered', doc.get('html'))) or ''
     return prepare_html(html.encode('utf8'))
 
 
@@ -1,55 +1,57 @@
 # -*- coding: utf-8 -*-
-from __future__ import absolute_import
 import os
+import hashlib
 from sklearn.externals import joblib
-import lxml.html.clean
-import lxml.html
-import lxml.etree
-import html2text
-
-def _tree2text(tree):
-    cleaner = lxml.html.clean.Cleaner(
-        style=True, 
-        scripts=True, 
-        javascript=True, 
-        comments=True, 
-        embedded=True, 
-        forms=False, 
-        page_structure=False,
-    )
-    
-    tree = cleaner.clean_html(tree)
-    html = lxml.html.tostring(tree)
-    doc = lxml.html.document_fromstring(html)
-    return ' '.join(doc.text_content().split())
-
-def prepare_htmltext(html):
-    tree = lxml.html.fromstring(html)
-    return _tree2text(tree)
-
-def prepare_doc(doc):
-    html = doc.get('html_rendered', doc['html'])
-    return prepare_htmltext(html.encode('utf8'))
+from html import prepare_html, prepare_mongodoc
 
 class Ranker(object):
 
     MODEL = os.path.join(os.path.dirname(__file__), 'models', 'model.joblib')
 
-    def __init__(self, pipe):
+    def __init__(self, pipe, version=None):
         self.pipe = pipe
+        self.version = version
 
     @classmethod
     def load(cls, path=MODEL):
-        return Ranker(joblib.load(path))
+        return Ranker(joblib.load(path), version=cls.model_version(path))
+
+    @classmethod
+    def model_version(cls, path=MODEL):
+        """Digest of the saved model, scores stored with it are current as long as it matches"""
+
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
 
     def score_html(self, html_utf8):
-        X = [prepare_htmltext(html_utf8)]
+        X = [prepare_html(html_utf8)]
         return self.pipe.predict_proba(X)[0][1]
 
     def score_doc(self, doc):
-        X = [prepare_doc(doc)]
+        X = [prepare_mongodoc(doc)]
         return self.pipe.predict_proba(X)[0][1]
 
+    def score_texts(self, texts):
+        """Scores of already extracted texts from one predict_proba call, None texts score 0"""
+
+        scores = [0] * len(texts)
+        index = [i for i, text in enumerate(texts) if text is not None]
+        if index:
+            for i, proba in zip(index, self.pipe.predict_proba([texts[i] for i in index])[:, 1]):
+                scores[i] = float(proba)
+        return scores
+
+    def score_docs(self, docs):
+        """Scores of docs from one predict_proba call, docs that can't be prepared score 0"""
+
+        texts = []
+        for doc in docs:
+            try:
+                texts.append(prepare_mongodoc(doc))
+            except Exception:
+                texts.append(None)
+        return self.score_texts(texts)
+
 if __name__ == "__main__":
     
     Ranker.load()
\ No newline at end of file
@@ -3,39 +3,115 @@
 
 from tqdm import tqdm
 from ranker import Ranker
+from extract import iter_texts, chunks
+from html import TEXT_VERSION
 from ui.mongoutils.memex_mongo_utils import MemexMongoUtils
-from train import train_on_user_input
+from train import train_on_user_input, update_on_user_input
 
-def _score_hosts():
+def _score_hosts(chunk_size=100):
 
     mmu = MemexMongoUtils()
+    mmu.refresh_host_scores()
+
+    hosts = []
     for host_doc in mmu.list_all_hosts():
-        print host_doc
-        score = mmu.get_host_score(host_doc["host"])
-        mmu.set_host_score(host_doc["host"], score)
+        hosts.append(host_doc["host"])
+        if len(hosts) == chunk_size:
+            mmu.refresh_best_screenshots(hosts)
+            hosts = []
+
+    if hosts:
+        mmu.refresh_best_screenshots(hosts)
+
+def _docs_to_score(mmu, ranker, docs, incremental, batch_size, counts, report=None):
+    """Url documents that need a score, with their stored text or else their body attached.
+
+    With incremental set, urls last scored with the same model on the same content, whose text is
+    stored by the current extractor, are skipped before their bodies are even loaded. counts["done"]
+    counts the urls looked at, report() is called after every batch of them.
+    """
+
+    for batch in chunks(docs, batch_size):
+        mmu.attach_texts(batch, TEXT_VERSION)
+        counts["done"] += len(batch)
+        if report:
+            report()
+        if incremental:
+            # without a current stored text the score may come from an older extractor's text
+            batch = [url_doc for url_doc in batch
+                     if not (url_doc["content_hash"] and url_doc.get("score_model") == ranker.version
+                             and url_doc.get("score_content") == url_doc["content_hash"] and "text" in url_doc)]
+
+        # bodies are only needed for pages whose text isn't stored yet
+        mmu.attach_content([url_doc for url_doc in batch if "text" not in url_doc])
+        for url_doc in batch:
+            yield url_doc
+
+def _save_scores(mmu, ranker, scored):
+    """Score a batch of (url document, text) with one prediction and one bulk write"""
 
-def train_and_score_mongo():
-    """ Rescore all items from mongo """
+    scores = ranker.score_texts([text for url_doc, text in scored])
+    mmu.set_scores([(url_doc["url"], score, url_doc["content_hash"]) for (url_doc, text), score in zip(scored, scores)],
+                   model_version=ranker.version)
+
+def train_and_score_mongo(progress=None, retrain=True, partial=False, incremental=True, batch_size=200, workers=None):
+    """ Rescore all items from mongo
+
+    Urls are streamed through a pool of workers extracting the texts not stored yet (see extract.py)
+    and scored batch_size at a time. Without retrain the saved model is reused and, with incremental,
+    only urls that are new or whose content changed since they were scored get scored. With partial
+    the saved model is only updated with the labels it hasn't learned yet (hashing models, see train.py).
+
+    progress, if given, is called with stage="training" while the labelled urls are read, then
+    stage="scoring" with the done and total url counts after every batch looked at and finally with
+    stage="hosts". Returns the counts.
+    """
     
-    print "**************Training*********************"
-    train_on_user_input()
+    if retrain:
+        print "**************Training*********************"
+        if progress:
+            progress(stage="training")
+        if partial:
+            update_on_user_input(workers=workers, progress=progress)
+        else:
+            train_on_user_input(workers=workers, progress=progress)
 
 
     print "**************Scoring and Indexing*****************"
     mmu = MemexMongoUtils()
-    docs = mmu.list_all_urls_iterator(return_html = True)
+    total = mmu.urlinfo_collection.count()
+    docs = mmu.iter_urls(sort_by="_id", fields=["url", "host", "score_model", "score_content"],
+                         list_deleted=True, batch_size=batch_size)
 
     ranker = Ranker.load()
-    for doc in tqdm(docs, leave = True):
-        try:
-            score = ranker.score_doc(doc)
-        except:
-            score = 0
+    counts = {"done" : 0, "scored" : 0}
+    extraction = {}
+    batch = []
 
-        mmu.set_score(doc["url"], score)
+    def report():
+        # per batch looked at rather than scored, incremental runs may skip most of them
+        if progress:
+            progress(stage="scoring", done=counts["done"], total=total, scored=counts["scored"],
+                     extracted_per_second=round(extraction.get("per_second", 0.0), 2))
 
+    candidates = _docs_to_score(mmu, ranker, docs, incremental, batch_size, counts, report)
+    for url_doc, text in tqdm(iter_texts(mmu, candidates, workers=workers, batch_size=batch_size, stats=extraction), leave = True):
+        batch.append((url_doc, text))
+        if len(batch) == batch_size:
+            _save_scores(mmu, ranker, batch)
+            counts["scored"] += len(batch)
+            batch = []
+
+    if batch:
+        _save_scores(mmu, ranker, batch)
+        counts["scored"] += len(batch)
+
+    if progress:
+        progress(stage="hosts", done=counts["done"], total=total, scored=counts["scored"])
     _score_hosts()
 
+    return {"urls" : counts["done"], "scored" : counts["scored"]}
+
 
 if __name__ == '__main__':
    train_and_score_mongo()
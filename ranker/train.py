@@ -9,21 +9,25 @@ sys.path.insert(0, '../../')
 import os
 import glob
 import numpy as np
-import lxml.html.clean
-import lxml.html
-import lxml.etree
 import html2text
 from tqdm import tqdm
 from ui.mongoutils.memex_mongo_utils import MemexMongoUtils
 
 from sklearn.externals import joblib
-from sklearn.linear_model import LogisticRegression
+from sklearn.linear_model import LogisticRegression, SGDClassifier
 from sklearn.pipeline import Pipeline, FeatureUnion
 from sklearn.cross_validation import train_test_split, cross_val_score
 from sklearn.metrics import classification_report
-from sklearn.feature_extraction.text import TfidfVectorizer, CountVectorizer
+from sklearn.feature_extraction.text import TfidfVectorizer, CountVectorizer, HashingVectorizer
 
 from ranker import Ranker
+from html import prepare_htmlfile
+from extract import iter_texts, with_texts
+
+# Model trained by train_on_user_input. "count" learns a vocabulary that grows with the corpus,
+# "hashing" has a fixed size and can take new labels with update_on_user_input.
+RANKER_MODEL = os.environ.get("RANKER_MODEL", "count")
+HASHING_FEATURES = 2 ** 18
 
 def get_informative_features(vectorizer, clf, class_labels, N):
     """
@@ -56,38 +60,10 @@ def get_informative_features_binary(vec, clf, top):
     return dict(get_informative_features(vec, clf, [0], top))[0]
 
 
-def _tree2text(tree):
-    cleaner = lxml.html.clean.Cleaner(
-        style=True, 
-        scripts=True, 
-        javascript=True, 
-        comments=True, 
-        embedded=True, 
-        forms=False, 
-        page_structure=False,
-    )
-    
-    tree = cleaner.clean_html(tree)
-    html = lxml.html.tostring(tree)
-    doc = lxml.html.document_fromstring(html)
-    return ' '.join(doc.text_content().split())
-    
-def prepare_htmltext(html):
-    tree = lxml.html.fromstring(html)
-    return _tree2text(tree)
-
-
-def prepare_html(fn):
-    with open(fn, 'rb') as f:
-        tree = lxml.html.parse(f)
-        
-    return _tree2text(tree)
-
-
 def load_documents(pat):    
     for fn in tqdm(glob.glob(pat), leave=True):
         try:
-            yield prepare_html(fn)
+            yield prepare_htmlfile(fn)
         except Exception as e:
             print("error processing %s: %s" % (fn, e))
             
@@ -101,11 +77,45 @@ def get_mdocs(interest):
     mmu = MemexMongoUtils()
     return mmu.list_all_urls_with_interest(interest, return_html = True)
 
-def prepare_doc(doc):
-    html = doc.get('html_rendered', doc['html'])
-    return prepare_htmltext(html.encode('utf8'))
+def _reporting(docs, progress, every=200):
+    """docs, calling progress(stage="training", labelled=...) every so many of them"""
+
+    for i, doc in enumerate(docs):
+        if progress and i % every == 0:
+            progress(stage="training", labelled=i)
+        yield doc
+
+def _extract_mdocs(query, workers=None, progress=None):
+    """Urls matching query with their texts and interest labels, stored texts are reused and new ones stored"""
+
+    mmu = MemexMongoUtils()
+    docs = mmu.iter_urls(sort_by="_id", query=query, fields=["url", "host", "interest"], list_deleted=True)
+    docs = _reporting(docs, progress)
+    labelled = [(doc["url"], text, doc["interest"]) for doc, text in iter_texts(mmu, with_texts(mmu, docs), workers=workers)
+                if text is not None]
+    return [url for url, text, interest in labelled], [text for url, text, interest in labelled], \
+           [interest for url, text, interest in labelled]
+
+def make_pipeline(model=None):
+    """Untrained vectorizer/classifier pipeline of the given kind, RANKER_MODEL by default"""
+
+    model = model or RANKER_MODEL
+    if model == "count":
+        vec = CountVectorizer(min_df=2, ngram_range=(1,2)) #, stop_words='english')
+        clf = LogisticRegression(C=0.1, penalty='l2')
+    elif model == "hashing":
+        # stateless vectorizer, the model is the classifier's coefficients only
+        vec = HashingVectorizer(n_features=HASHING_FEATURES, ngram_range=(1,2))
+        clf = SGDClassifier(loss='log', penalty='l2', alpha=1e-5)
+    else:
+        raise ValueError("Unknown ranker model %r" % model)
+
+    return Pipeline([
+        ('vec', vec),
+        ('clf', clf),
+    ])
 
-def train_on_user_input():
+def train_on_user_input(workers=None, model=None, progress=None):
 
     #docs_pos = list(load_documents('../data/train/pos/*.html'))
     #docs_neg = list(load_documents('../data/train/neg/*.html'))
@@ -113,8 +123,8 @@ def train_on_user_input():
     #X_Amanda, y_Amanda = posneg2xy(docs_pos, docs_neg)
     #X_Amanda, y_Amanda = posneg2xy(docs_pos, [])
     
-    docs_mongo_pos = [prepare_doc(doc) for doc in get_mdocs(True)]
-    docs_mongo_neg = [prepare_doc(doc) for doc in get_mdocs(False)]
+    urls_pos, docs_mongo_pos, _ = _extract_mdocs({"interest" : True}, workers, progress)
+    urls_neg, docs_mongo_neg, _ = _extract_mdocs({"interest" : False}, workers, progress)
     
     print "Positive examples: " + str(len(docs_mongo_pos))
     print "Negative examples: " + str(len(docs_mongo_neg))
@@ -128,13 +138,9 @@ def train_on_user_input():
     
     X_train, X_test, y_train, y_test = train_test_split(X, y)
     
-    vec = CountVectorizer(min_df=2, ngram_range=(1,2)) #, stop_words='english')
-    clf = LogisticRegression(C=0.1, penalty='l2')
-    
-    pipe = Pipeline([
-        ('vec', vec),
-        ('clf', clf),
-    ])
+    pipe = make_pipeline(model)
+    vec = pipe.named_steps['vec']
+    clf = pipe.named_steps['clf']
     
     pipe.fit(X_train, y_train)
     y_pred = pipe.predict(X_test)
@@ -148,10 +154,31 @@ def train_on_user_input():
         
     pipe.fit(X, y)
     
-    MODEL = os.path.join(os.path.dirname(__file__), 'models', 'model.joblib')    
-    joblib.dump(pipe, MODEL, compress=1)
+    joblib.dump(pipe, Ranker.MODEL, compress=1)
+    MemexMongoUtils().mark_learned(urls_pos + urls_neg, [True] * len(urls_pos) + [False] * len(urls_neg))
     #get_ipython().system(u"ls -lh '../../ranker/models/'")
     
 #    ranker = Ranker.load()
 #    ranker.score_doc(get_mdocs(True)[4])
-    
+
+
+def update_on_user_input(workers=None, progress=None):
+    """Fold the urls labelled since the saved model last learned them into it with partial_fit and
+    return how many there were. Models that can't be updated (the count model) are retrained.
+    """
+
+    pipe = joblib.load(Ranker.MODEL) if os.path.exists(Ranker.MODEL) else None
+    if pipe is None or not hasattr(pipe.named_steps['clf'], 'partial_fit'):
+        print "Saved model can't be updated, retraining"
+        train_on_user_input(workers=workers, progress=progress)
+        return None
+
+    urls, X, y = _extract_mdocs({"interest" : {"$in" : [True, False]}, "learned" : {"$ne" : True}}, workers, progress)
+    print "New examples: " + str(len(X))
+    if not X:
+        return 0
+
+    pipe.named_steps['clf'].partial_fit(pipe.named_steps['vec'].transform(X), y, classes=[False, True])
+    joblib.dump(pipe, Ranker.MODEL, compress=1)
+    MemexMongoUtils().mark_learned(urls, y)
+    return len(X)
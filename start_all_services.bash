@@ -18,8 +18,12 @@ if [ ! -f /sourcepin_inst ]; then
     touch /sourcepin_inst
 fi
 
+# bring data stored by older versions up to date before the UI workers start
+python migrate.py
+
 cd ../../
 export PYTHONPATH=`pwd`
 cd ui
 
-gunicorn -w 8 --log-level debug --bind=0.0.0.0:80 --timeout 1200 server:app
\ No newline at end of file
+# UI_WORKERS processes with UI_THREADS threads each serve requests concurrently
+gunicorn -w ${UI_WORKERS:-8} --threads ${UI_THREADS:-4} --log-level debug --bind=0.0.0.0:80 --timeout 1200 server:app
\ No newline at end of file
@@ -0,0 +1,101 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import request, Response
+from ui.settings import RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL
+from mongoutils.memex_mongo_utils import MemexMongoUtils
+
+
+class ResponseCache(object):
+    """LRU cache of rendered responses whose entries expire after ttl seconds.
+
+    Entries are keyed by a change counter kept in mongo (see cached_response), so a write made by
+    any server process or crawl makes every process miss, the ttl only bounds memory use.
+    """
+
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+
+            # re-insert as the most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {"hits" : self.hits, "misses" : self.misses, "evictions" : self.evictions,
+                    "entries" : len(self._entries),
+                    "max_entries" : self.max_entries, "ttl" : self.ttl}
+
+
+response_cache = ResponseCache()
+
+
+def cached_response(route, which_collection=None):
+    """Cache the 200 responses of a GET view by workspace, route, view args, query string and
+    Accept header (the listings render html or json depending on it).
+
+    The key holds a change counter (MemexMongoUtils.get_change_counter): the one of which_collection
+    for listings, else the one bumped by changes that show everywhere (workspaces, keywords, search
+    terms). Views listing which_collection also get a strong ETag made from it, an If-None-Match
+    naming the current one is answered with a 304 before the view runs.
+    """
+
+    def decorator(view):
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+
+            mmu = MemexMongoUtils(which_collection=which_collection or "crawl-data")
+            counter = mmu.get_change_counter(everywhere=not which_collection)
+
+            key = (mmu.workspace_name, route, counter, tuple(sorted(request.view_args.items())),
+                   tuple(sorted(request.args.items(multi=True))), str(request.accept_mimetypes))
+            etag = hashlib.sha1(repr(key)).hexdigest() if which_collection else None
+            if etag and request.if_none_match.contains(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+
+            cached = response_cache.get(key)
+            if cached is not None:
+                body, mimetype = cached
+                response = Response(body, mimetype=mimetype)
+            else:
+                response = view(*args, **kwargs)
+                if isinstance(response, basestring):
+                    response = Response(response)
+                # streamed responses are left alone, buffering them would defeat the point
+                if response.status_code == 200 and not response.is_streamed:
+                    response_cache.set(key, (response.get_data(), response.mimetype))
+
+            if etag and response.status_code == 200:
+                response.set_etag(etag)
+            return response
+
+        return wrapper
+
+    return decorator
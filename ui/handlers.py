@@ -1,16 +1,16 @@
 from flask import request
-from mongoutils.memex_mongo_utils import MemexMongoUtils
+from mongoutils.memex_mongo_utils import MemexMongoUtils, encode_page_token, tag_search_keys
 from scrapyutils.scrapydutil import ScrapydJob
 from ui.settings import SCREENSHOT_DIR
 from mongoutils.known_hosts import KnownHostsCompare
 from mongoutils.validate import validate_url
+from jobs import start_job, start_process_job, JOB_DEAD_AFTER
 import traceback
 try:
     from ranker.rescore_mongo import train_and_score_mongo
 except:
     print "****Warning: Scoring is disabled because: ****"
     traceback.print_exc()
-import re
 
 
 def get_screenshot_relative_path(real_path):
@@ -35,18 +35,11 @@ def get_page_number_for_host(path, page_size, current_host, filter_field=None, f
 
     mmu = MemexMongoUtils(which_collection=which_collection)
 
-    max_page_size = 100*100 # max results per page
-    host_dics = mmu.list_hosts(page=1, page_size=max_page_size, filter_field=filter_field, filter_regex=filter_regex, show_all=show_all)
-    i = 0
-    current_page = 0
-    for host_dic in host_dics:
-        if host_dic["host"] == current_host:
-            current_page = (i/page_size)
-            break
-        else:
-            i += 1
+    rank = mmu.get_host_rank(current_host, filter_field=filter_field, filter_regex=filter_regex, show_all=show_all)
+    if rank is None:
+        return 0
 
-    return current_page
+    return rank // page_size
 
 
 
@@ -64,8 +57,11 @@ def get_collection_by_path(path):
     return which_collection
 
 
-def hosts_handler(page=1, page_size=10, current_host=None, which_collection="crawl-data", filter_field=None, filter_regex=None, show_all=None):
-    """Put together host documents for use with hosts endpoint """
+def hosts_handler(page=1, page_size=10, current_host=None, which_collection="crawl-data", filter_field=None, filter_regex=None, show_all=None, after=None):
+    """Put together host documents for use with hosts endpoint
+
+    Every host document gets a page_token, passing it back as after returns the hosts that follow it.
+    """
 
     mmu = MemexMongoUtils(which_collection = which_collection)
     # for host in mmu.get_hosts_filtered(filter_field = "host", filter_regex = "windows"):
@@ -75,34 +71,36 @@ def hosts_handler(page=1, page_size=10, current_host=None, which_collection="cra
     khc = KnownHostsCompare()
 
     if current_host:
-        current_page_size = page_size_max = 10*100 # max results per page
+        # everything from page up to and including the page current_host is on
+        rank = mmu.get_host_rank(current_host, filter_field=filter_field, filter_regex=filter_regex, show_all=show_all)
+        if rank is None:
+            current_page_size = page_size
+        else:
+            current_page_size = max((rank // page_size + 1) * page_size - (page - 1) * page_size, page_size)
         host_dics = mmu.list_hosts(page=page, page_size=current_page_size, filter_field=filter_field, filter_regex=filter_regex, show_all=show_all)
-        matched=False
-        i = 0
-        for host_dic in host_dics:
-            i += 1
-            if host_dic["host"] == current_host:
-                matched = True
-            if matched and (i % page_size == 0):
-                break
-
-        # clean the leftovers
-        n = len(host_dics)
-        for x in range(i, n):
-            host_dics.pop()
 
     else:
-        host_dics = mmu.list_hosts(page=page, page_size=page_size, filter_field=filter_field, filter_regex=filter_regex, show_all=show_all)
+        host_dics = mmu.list_hosts(page=page, page_size=page_size, filter_field=filter_field, filter_regex=filter_regex, show_all=show_all, after=after)
+
 
+    # hosts carry a denormalized pointer to their best screenshot, only hosts that predate it need a lookup
+    hsus = mmu.get_highest_scoring_urls_with_screenshot([host_dic["host"] for host_dic in host_dics
+                                                         if "best_screenshot_path" not in host_dic])
+
+    known_hosts = khc.known_hosts([host_dic["host"] for host_dic in host_dics])
 
     for host_dic in host_dics:
 
         #print host_dic
         #host scoring is added here as is known hostedness
+        host_dic["page_token"] = encode_page_token(host_dic)
         host_dic.pop("_id")
-        is_known_host = khc.is_known_host(host_dic["host"])
+        is_known_host = host_dic["host"] in known_hosts
         host_dic["is_known_host"] = is_known_host
-        hsu = mmu.get_highest_scoring_url_with_screenshot(host_dic["host"])
+        if "best_screenshot_path" in host_dic:
+            hsu = {"screenshot_path" : host_dic["best_screenshot_path"]}
+        else:
+            hsu = hsus.get(host_dic["host"])
         #host_score = mmu.get_host_score(host_dic["host"])
         #host_dic["host_score"] = host_score
 
@@ -115,21 +113,42 @@ def hosts_handler(page=1, page_size=10, current_host=None, which_collection="cra
     return host_dics
 
 
+def explain_hosts_filter_handler(filter_field, filter_regex, which_collection="crawl-data", show_all=None):
+
+    mmu = MemexMongoUtils(which_collection = which_collection)
+    return mmu.explain_hosts_filter(filter_field, filter_regex, show_all=show_all)
+
+
+# Fields of the url listings, the rest is served per url by url_detail_handler
+URL_LIST_FIELDS = ["url", "host", "score", "crawled_at", "is_seed", "title", "screenshot_path", "interest", "display"]
+
+
+def _prepare_url_dic(url_dic):
+
+    url_dic.pop("_id", None)
+    try:
+        date = url_dic["crawled_at"]
+        url_dic["crawled_at"] = date.strftime("%Y-%m-%d %H:%M:%S")
+    except:
+        url_dic["crawled_at"] = None
+    return url_dic
+
+
 def urls_handler(host = None, which_collection  = "crawl-data"):
-    """Put together host documents for use with hosts endpoint """
+    """Put together url documents for use with urls endpoint, a generator reading them off the cursor"""
 
     mmu = MemexMongoUtils(which_collection = which_collection)
-    url_dics = mmu.list_urls(host = host, limit = 1000)
+    for url_dic in mmu.find_urls(host = host, limit = 1000, fields = URL_LIST_FIELDS):
+        yield _prepare_url_dic(url_dic)
 
-    for url_dic in url_dics:
-        url_dic.pop("_id")
-        try:
-            date = url_dic["crawled_at"]
-            url_dic["crawled_at"] = date.strftime("%Y-%m-%d %H:%M:%S")
-        except:
-            url_dic["crawled_at"] = None
 
-    return url_dics
+def url_detail_handler(url, which_collection = "crawl-data", return_html = False):
+
+    mmu = MemexMongoUtils(which_collection = which_collection)
+    url_dic = mmu.get_url(url, return_html = return_html)
+    if url_dic is None:
+        return None
+    return _prepare_url_dic(url_dic)
 
 
 def schedule_spider_handler(seed, spider_host = "localhost", spider_port = "6800"):
@@ -146,12 +165,14 @@ def schedule_spider_handler(seed, spider_host = "localhost", spider_port = "6800
 def add_known_urls_handler(urls_raw):
 
     mmu = MemexMongoUtils(which_collection = "known-data")
-    for url in urls_raw.splitlines():
+    urls = urls_raw.splitlines()
+    for url in urls:
         validate_url(url)
-        try:
-            mmu.insert_url(url = url)
-        except:
-            print "Existing URL attempted to be uploaded, skipping it..."
+
+    # existing urls are skipped and not counted again by insert_urls
+    chunk_size = 1000
+    for i in xrange(0, len(urls), chunk_size):
+        mmu.insert_urls([{"url" : url} for url in urls[i:i + chunk_size]])
 
 
 def get_job_state_handler(url, spider_host = "localhost", spider_port = "6800"):
@@ -187,7 +208,7 @@ def mark_interest_handler(interest, url):
 
 def set_score_handler(url, score):
     mmu = MemexMongoUtils()
-    mmu.set_score(url, score)
+    mmu.set_score(url, float(score))
 
 ##workspace    
 ############# TAGS #############
@@ -201,9 +222,12 @@ def save_tags(host, tags):
     mmu = MemexMongoUtils()
     mmu.save_tags(host, tags)
 
-def search_tags(term):
+def search_tags(term, limit=20):
     mmu = MemexMongoUtils()
-    search_results_docs = mmu.search_tags(term)
+    search_results_docs = mmu.search_tags(term, limit=limit)
+    if search_results_docs == None:
+        return None
+
     tag_search_results_docs = search_results_docs["tag_matches"]
     for doc in tag_search_results_docs:
         _add_filtered_tags(doc, term)
@@ -211,11 +235,12 @@ def search_tags(term):
     return search_results_docs
 
 def _add_filtered_tags(doc, term):
-    #adds tags_filtered field
+    #adds tags_filtered field, the tags that matched the search
+    key = term.strip().lower()
     tags_filtered = []
     if "tags" in doc:
         for tag in doc["tags"]:
-            if re.search(term, tag, re.IGNORECASE):
+            if any(tag_key.startswith(key) for tag_key in tag_search_keys([tag])):
                 tags_filtered.append(tag)
             
     doc["tags_filtered"] = tags_filtered
@@ -224,16 +249,39 @@ def _add_filtered_tags(doc, term):
 
 def save_display(host, displayable):
     mmu = MemexMongoUtils()
-    if not bool(displayable):
-        for url_doc in mmu.list_urls(host = host, limit=100000000):
-            mmu.set_interest(url_doc["url"], False)
+    return mmu.save_display(host, displayable)
+
+def save_displays(hosts, displayable):
+    mmu = MemexMongoUtils()
+    return mmu.save_displays(hosts, displayable)
 
-    else:
+############# Deleting #############
 
-        for url_doc in mmu.list_urls(host = host, limit=100000000):
-            mmu.set_interest(url_doc["url"], True)
+_deletes = {
+    "url" : MemexMongoUtils.delete_urls_by_match,
+    "host" : MemexMongoUtils.delete_hosts_by_match,
+    "all" : MemexMongoUtils.delete_all_by_match,
+}
 
-    return mmu.save_display(host, displayable)
+def start_delete_job(match, negative_match=False, by="url"):
+    """Delete urls and hosts matching match in the background, returns the job id"""
+
+    mmu = MemexMongoUtils()
+    return start_job(mmu, "delete-by-" + by, _deletes[by], match=match, negative_match=negative_match)
+
+def get_job_handler(job_id):
+    mmu = MemexMongoUtils()
+    mmu.fail_dead_background_jobs(JOB_DEAD_AFTER)
+    return mmu.get_background_job(job_id)
+
+def cancel_job_handler(job_id):
+    mmu = MemexMongoUtils()
+    return mmu.cancel_background_job(job_id)
+
+def list_jobs_handler(kind=None, limit=50):
+    mmu = MemexMongoUtils()
+    mmu.fail_dead_background_jobs(JOB_DEAD_AFTER)
+    return mmu.list_background_jobs(kind=kind, limit=limit)
 
 ############# Workspaces #############
 
@@ -290,13 +338,22 @@ def schedule_spider_searchengine_handler(search_terms, spider_host="localhost",
 def get_score_handler():
 
     mmu = MemexMongoUtils()
-    yes_interest_docs = mmu.list_all_urls_with_interest(True, return_html = True)
-    no_interest_docs = mmu.list_all_urls_with_interest(False, return_html = True)
-    return yes_interest_docs, no_interest_docs
+    num_yes_interest = mmu.count_urls_with_interest(True)
+    num_no_interest = mmu.count_urls_with_interest(False)
+    return num_yes_interest, num_no_interest
 
-def rescore_db_handler():
+def _rescore(mmu, progress, retrain=True, partial=False):
+    return train_and_score_mongo(progress=progress, retrain=retrain, partial=partial)
 
-    train_and_score_mongo()
+def rescore_db_handler(retrain=True, partial=False):
+    """Retrain (unless retrain is off, only on new labels with partial) and rescore in a worker
+    process, returns the job id. Raises JobRunningError while a rescore of the workspace runs,
+    two would train the same model file and write scores over each other."""
+
+    mmu = MemexMongoUtils()
+    # a rescore whose process died must not hold up the next one
+    mmu.fail_dead_background_jobs(JOB_DEAD_AFTER)
+    return start_process_job(mmu, "rescore", _rescore, exclusive=True, retrain=retrain, partial=partial)
 
 
 def get_blur_level():
@@ -0,0 +1,103 @@
+import multiprocessing
+import threading
+import time
+import traceback
+from datetime import datetime
+from mongoutils.memex_mongo_utils import MemexMongoUtils
+
+
+# Seconds between heartbeats of a running job, jobs silent for JOB_DEAD_AFTER are taken for dead
+# (see MemexMongoUtils.fail_dead_background_jobs)
+JOB_HEARTBEAT = 10
+JOB_DEAD_AFTER = 60
+
+
+class JobCancelled(Exception):
+    """Raised by progress() once cancellation of the running job has been requested"""
+
+
+def start_job(mmu, kind, target, exclusive=False, **kwargs):
+    """Run target(mmu, progress=..., **kwargs) in a background thread and return the job id.
+
+    The job is recorded with MemexMongoUtils.create_background_job, progress(**counts) stores the
+    running counts on it and the job ends up "done" with target's return value as result, "failed"
+    or "cancelled". A running job beats every JOB_HEARTBEAT seconds so one whose process died can
+    be told apart.
+    mmu is shared with the thread so the job keeps working on the collections it was started on.
+    An exclusive job raises JobRunningError while another one of its kind runs on them.
+    """
+
+    job_id = mmu.create_background_job(kind, kwargs, exclusive=exclusive)
+
+    thread = threading.Thread(target=_run_job, args=(mmu, job_id, target, kwargs))
+    thread.daemon = True
+    thread.start()
+
+    return job_id
+
+
+def start_process_job(mmu, kind, target, exclusive=False, **kwargs):
+    """start_job for CPU bound work, target runs in a worker process of its own.
+
+    The worker connects to mongo itself and works on mmu's collection type (the selected workspace
+    for crawl data). Server processes can serve requests meanwhile and any of them can report on
+    or cancel the job, its state lives in the jobs collection.
+    """
+
+    job_id = mmu.create_background_job(kind, kwargs, exclusive=exclusive)
+
+    # reap workers of earlier jobs
+    multiprocessing.active_children()
+
+    # not a daemon, daemonic processes can't start the extraction pools the ranker uses
+    process = multiprocessing.Process(target=_run_process_job, args=(mmu.which_collection, job_id, target, kwargs))
+    process.start()
+    mmu.update_background_job(job_id, pid=process.pid)
+
+    return job_id
+
+
+def _run_process_job(which_collection, job_id, target, kwargs):
+    _run_job(MemexMongoUtils(which_collection=which_collection), job_id, target, kwargs)
+
+
+def _run_job(mmu, job_id, target, kwargs):
+
+    # time and count of the first report with a done count, earlier stages (training) don't count towards throughput
+    first_done = {}
+
+    def progress(**counts):
+        """Store counts on the job, counts with done and total also get throughput and ETA"""
+
+        if "done" in counts and "total" in counts:
+            if not first_done:
+                first_done.update(at=time.time(), done=counts["done"])
+            elapsed = time.time() - first_done["at"]
+            per_second = (counts["done"] - first_done["done"]) / elapsed if elapsed > 0 else 0.0
+            counts["per_second"] = round(per_second, 2)
+            counts["eta_seconds"] = int((counts["total"] - counts["done"]) / per_second) if per_second else None
+
+        job_doc = mmu.update_background_job(job_id, progress=counts, updated_at=datetime.utcnow())
+        if job_doc and job_doc.get("cancel_requested"):
+            raise JobCancelled()
+
+    stopped = threading.Event()
+
+    def heartbeat():
+        while not stopped.wait(JOB_HEARTBEAT):
+            mmu.update_background_job(job_id, heartbeat_at=datetime.utcnow())
+
+    beating = threading.Thread(target=heartbeat)
+    beating.daemon = True
+    beating.start()
+
+    try:
+        result = target(mmu, progress=progress, **kwargs)
+        mmu.finish_background_job(job_id, "done", result=result)
+    except JobCancelled:
+        mmu.finish_background_job(job_id, "cancelled")
+    except Exception:
+        traceback.print_exc()
+        mmu.finish_background_job(job_id, "failed", error=traceback.format_exc())
+    finally:
+        stopped.set()
@@ -3,3 +3,10 @@ class DeletingSelectedWorkspaceError(Exception):
         self.value = value
     def __str__(self):
         return repr(self.value)
+
+class JobRunningError(Exception):
+    """An exclusive background job was started while another one of its kind runs, job_id is that one's"""
+    def __init__(self, job_id):
+        self.job_id = job_id
+    def __str__(self):
+        return "Job %s is still running" % self.job_id
@@ -0,0 +1,74 @@
+import re
+
+# Time limit for host filters that have to fall back to a real $regex
+REGEX_MAX_TIME_MS = 2000
+
+# What a host name or a tag may contain and still be taken literally, "." included
+_LITERAL = re.compile(r"^[\w.\- ]+$", re.UNICODE)
+
+
+_REGEX_SPECIAL = re.compile(r"([\\^$.|?*+()\[\]{}])")
+
+
+def _literal(value):
+    return bool(_LITERAL.match(value))
+
+
+def _escape(value):
+    """value as a regex matching it literally, only regex syntax is escaped (unlike re.escape)"""
+
+    return _REGEX_SPECIAL.sub(r"\\\1", value)
+
+
+def prefix_regex(value):
+    """Anchored regex matching strings that start with value, escaped so that mongo recognizes it
+    as a simple prefix and bounds the index scan.
+    """
+
+    return "^" + _escape(value)
+
+
+def compile_filter(filter_field, filter_regex):
+    """Compile the filter typed into the host grid into a mongo query on filter_field and tags.
+
+    Returns {"plan" : ..., "query" : ..., "max_time_ms" : ...}, plan being one of
+
+    - exact:    ^value$ matches the field or a tag exactly, answered by the host and tags indexes
+    - prefix:   ^value matches the field or a tag starting with value, case sensitive like the
+                regex. Mongo bounds the index scan by the anchored $regex
+    - contains: a plain host name/tag matches the field or a tag containing it anywhere, it runs
+                as $regex with a time limit
+    - regex:    anything else is a real regex, it runs as $regex with a time limit
+
+    Raises ValueError for regexes that don't compile.
+    """
+
+    filter_regex = filter_regex.strip()
+    anchored = filter_regex.startswith("^")
+    value = filter_regex[1:] if anchored else filter_regex
+
+    if anchored and value.endswith("$") and _literal(value[:-1]):
+        value = value[:-1]
+        return {"plan" : "exact",
+                "query" : {'$or' : [{filter_field : value}, {"tags" : value}]},
+                "max_time_ms" : None}
+
+    if not anchored and _literal(value):
+        contains = _escape(value)
+        return {"plan" : "contains",
+                "query" : {'$or' : [{filter_field : {'$regex' : contains}}, {"tags" : {'$regex' : contains}}]},
+                "max_time_ms" : REGEX_MAX_TIME_MS}
+
+    if _literal(value):
+        return {"plan" : "prefix",
+                "query" : {'$or' : [{filter_field : {'$regex' : prefix_regex(value)}}, {"tags" : {'$regex' : prefix_regex(value)}}]},
+                "max_time_ms" : None}
+
+    try:
+        re.compile(filter_regex)
+    except re.error as e:
+        raise ValueError("Invalid filter %r: %s" % (filter_regex, e))
+
+    return {"plan" : "regex",
+            "query" : {'$or' : [{filter_field : {'$regex' : filter_regex}}, {"tags" : {'$regex' : filter_regex}}]},
+            "max_time_ms" : REGEX_MAX_TIME_MS}
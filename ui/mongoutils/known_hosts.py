@@ -1,19 +1,65 @@
+import threading
 from memex_mongo_utils import MemexMongoUtils
 
+_lock = threading.Lock()
+_cache = {"hosts" : frozenset(), "last_id" : None, "counter" : None}
+
+
 class KnownHostsCompare(object):
+    """Known hosts index shared by every instance in the process.
+
+    The hosts are refreshed whenever the change counter of the known urls moved since the last load,
+    so hosts added or removed through any process are seen by the next instance everywhere.
+    """
 
     def __init__(self):
-        mmu = MemexMongoUtils(which_collection = "known-data")
+        self.mmu = MemexMongoUtils(which_collection = "known-data")
+
+        counter = self.change_counter()
+        if counter != _cache["counter"]:
+            self.refresh(counter)
+
+    def change_counter(self):
+        """Changes to the known urls only, changes counted everywhere don't touch the known hosts"""
+
+        doc = self.mmu.changes_collection.find_one({"_id" : self.mmu.urlinfo_collection.name})
+        return doc["counter"] if doc else 0
+
+    def refresh(self, counter):
+        """Load the hosts added since the last load as of change counter. All of them are reloaded on
+        the first load, or when the host count shows some were removed or added out of _id order.
+        """
+
+        with _lock:
+            if counter == _cache["counter"]:
+                return
+
+            hosts = set(_cache["hosts"])
+            last_id = _cache["last_id"]
+            query = {"_id" : {"$gt" : last_id}} if last_id is not None else {}
+            for host_dic in self.mmu.hostinfo_collection.find(query, {"host" : 1}).sort("_id", 1):
+                hosts.add(host_dic["host"])
+                last_id = host_dic["_id"]
+
+            if query and len(hosts) != self.mmu.hostinfo_collection.count():
+                hosts = set()
+                last_id = None
+                for host_dic in self.mmu.hostinfo_collection.find({}, {"host" : 1}).sort("_id", 1):
+                    hosts.add(host_dic["host"])
+                    last_id = host_dic["_id"]
+
+            # swap in a new set so readers never see a half-built one
+            _cache["hosts"] = frozenset(hosts)
+            _cache["last_id"] = last_id
+            _cache["counter"] = counter
 
-        #!very inefficient, but such is life
-        self.known_hosts_list = [host_dic["host"] for host_dic in mmu.list_all_hosts()]
+    def is_known_host(self, host):
+        return host in _cache["hosts"]
 
-    def is_known_host(self, host):        
-        if host in self.known_hosts_list:
-            return True
-        else:
-            return False
+    def known_hosts(self, hosts):
+        """Return the subset of hosts that are known"""
+        return _cache["hosts"].intersection(hosts)
 
 if __name__ == "__main__":
     khc = KnownHostsCompare()
-    print khc.is_known_host("201-993-9388.escortsincollege.com")
\ No newline at end of file
+    print khc.is_known_host("201-993-9388.escortsincollege.com")
@@ -1,17 +1,254 @@
 import itertools
 import csv
+import os
+import threading
 import pymongo
 from pymongo import MongoClient
 import traceback
 import json
+import base64
+import hashlib
 from random import randrange
 from operator import itemgetter
 from urlparse import urlparse
-from pymongo.errors import DuplicateKeyError
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 from bson.objectid import ObjectId
-from errors import DeletingSelectedWorkspaceError
+from errors import DeletingSelectedWorkspaceError, JobRunningError
+from filters import compile_filter, prefix_regex
 from ui.utils.url import extract_tld
+from ui.utils.compression import compress_html, decompress_html, html_digest, HTML_ENCODING
 import re
+import time
+from datetime import datetime, timedelta
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+# Selected workspace of the current thread's workspace scope, see begin_workspace_scope
+_workspace_scope = threading.local()
+
+# Change counter bumped on changes that show up in every listing, see bump_changes
+ALL_CHANGES = "*"
+
+# Write error code of a unique index violation
+DUPLICATE_KEY = 11000
+
+# Page bodies are kept in a content collection next to urlinfo, keyed by url fingerprint
+CONTENT_FIELDS = ("html", "html_rendered")
+
+# Least seconds between the change counter bumps of insert_url, see bump_changes_throttled
+INSERT_BUMP_INTERVAL = 1.0
+
+
+def get_client(address="mongodb", port=27017):
+    """Return the process-wide MongoClient for address:port.
+
+    MongoClient keeps its own connection pool and is thread safe, but it must not be shared
+    across a fork, so clients are keyed by pid as well and a forked worker gets a fresh one.
+    """
+
+    key = (os.getpid(), address, port)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = MongoClient(address, port)
+                _clients[key] = client
+    return client
+
+
+def begin_workspace_scope():
+    """Look the selected workspace up at most once on this thread until end_workspace_scope.
+
+    The UI server opens a scope per request, so the instances a request builds share one lookup
+    while every request still sees selections made by any process.
+    """
+
+    _workspace_scope.active = True
+    _workspace_scope.resolved = False
+
+
+def end_workspace_scope():
+    _workspace_scope.active = False
+
+
+def _forget_selected_workspace():
+    # a selection made in the scope is seen by the rest of it
+    _workspace_scope.resolved = False
+
+
+def encode_page_token(host_doc):
+    """Opaque continuation token for the hosts following host_doc in (host_score desc, _id asc) order"""
+
+    return base64.urlsafe_b64encode(json.dumps([host_doc.get("host_score"), str(host_doc["_id"])]))
+
+
+def _after_page_token(token):
+    """Query matching the hosts that sort after the host the token was made from"""
+
+    try:
+        host_score, _id = json.loads(base64.urlsafe_b64decode(str(token)))
+        _id = ObjectId(_id)
+    except Exception:
+        raise ValueError("Invalid page token %r" % token)
+
+    # hosts without a score sort last in descending order
+    if host_score is None:
+        return {"host_score" : None, "_id" : {"$gt" : _id}}
+
+    return {'$or' : [{"host_score" : {"$lt" : host_score}},
+                     {"host_score" : host_score, "_id" : {"$gt" : _id}},
+                     {"host_score" : None}]}
+
+
+def _before_host(host_doc):
+    """Query matching the hosts that sort before host_doc in (host_score desc, _id asc) order"""
+
+    host_score = host_doc.get("host_score")
+    if host_score is None:
+        return {'$or' : [{"host_score" : {"$ne" : None}},
+                         {"host_score" : None, "_id" : {"$lt" : host_doc["_id"]}}]}
+
+    return {'$or' : [{"host_score" : {"$gt" : host_score}},
+                     {"host_score" : host_score, "_id" : {"$lt" : host_doc["_id"]}}]}
+
+
+def url_host(url):
+    """Host a url is filed under: its registered domain"""
+
+    extracted = extract_tld(url)
+    return extracted.domain + '.' + extracted.suffix
+
+
+def tag_search_keys(tags):
+    """Lowercase search keys of tags: every tag and each of its words"""
+
+    keys = set()
+    for tag in tags or []:
+        tag = tag.strip().lower()
+        if tag:
+            keys.add(tag)
+            keys.update(tag.split())
+    return sorted(keys)
+
+
+def host_search_keys(host):
+    """Lowercase search keys of a host: the host and each of its labels"""
+
+    host = host.lower()
+    keys = set([host])
+    keys.update(key for key in re.split(r"[.\-]", host) if key)
+    return sorted(keys)
+
+
+def ensure_url_indexes(urlinfo_collection):
+    urlinfo_collection.ensure_index("url", unique=True, drop_dups=True)
+    urlinfo_collection.ensure_index([("host", pymongo.ASCENDING), ("score", pymongo.DESCENDING)])
+
+
+def ensure_host_indexes(hostinfo_collection):
+    hostinfo_collection.ensure_index("host", unique=True, drop_dups=True)
+    hostinfo_collection.ensure_index([("host_score", pymongo.DESCENDING), ("_id", pymongo.ASCENDING)])
+    hostinfo_collection.ensure_index("tags")
+    hostinfo_collection.ensure_index("host_keys")
+    hostinfo_collection.ensure_index("tag_keys")
+
+
+def ensure_content_indexes(content_collection):
+    content_collection.ensure_index("host")
+
+
+def backfill_search_keys(hostinfo_collection, chunk_size=1000):
+    """Set the search keys of hosts stored before they existed, chunk_size hosts per unordered
+    bulk update. Run by migrate.py before the UI starts, returns how many hosts got keys.
+    """
+
+    host_docs = hostinfo_collection.find({"host_keys" : {"$exists" : False}}, {"host" : 1, "tags" : 1})
+    count = 0
+    while True:
+        chunk = list(itertools.islice(host_docs, chunk_size))
+        if not chunk:
+            return count
+
+        bulk = hostinfo_collection.initialize_unordered_bulk_op()
+        for host_doc in chunk:
+            bulk.find({"_id" : host_doc["_id"]}).update_one({'$set' : {"host_keys" : host_search_keys(host_doc["host"]),
+                                                                        "tag_keys" : tag_search_keys(host_doc.get("tags"))}})
+        bulk.execute()
+        count += len(chunk)
+
+
+def _duplicate_keys_only(bulk_error):
+    """Whether a BulkWriteError only holds unique index violations, the result of lost upsert races"""
+
+    details = bulk_error.details
+    return not details.get("writeConcernErrors") and \
+        all(error["code"] == DUPLICATE_KEY for error in details.get("writeErrors", []))
+
+
+def make_content_doc(url_doc, content):
+    """Content collection fields for the page bodies of url_doc, bodies are stored compressed
+    next to a <field>_hash digest of each, see attach_texts"""
+
+    content_doc = dict((field, compress_html(html)) for field, html in content.items())
+    content_doc.update((field + "_hash", html_digest(html)) for field, html in content.items() if html is not None)
+    content_doc.update({"url" : url_doc["url"], "host" : url_doc["host"], "content_encoding" : HTML_ENCODING})
+    return content_doc
+
+
+def move_inline_content(urlinfo_collection, content_collection, chunk_size=200):
+    """Move the page bodies that urls stored before the content collection existed carry inline
+    into content_collection, chunk_size urls per unordered bulk write. A body the content collection
+    already holds (a later render) is kept. Run by migrate.py, returns how many urls were moved.
+    """
+
+    inline = {"$or" : [{field : {"$exists" : True}} for field in CONTENT_FIELDS]}
+    projection = dict((field, 1) for field in ("url", "host") + CONTENT_FIELDS)
+    count = 0
+    last_id = None
+    while True:
+        query = {"$and" : [inline, {"_id" : {"$gt" : last_id}}]} if last_id else inline
+        chunk = list(urlinfo_collection.find(query, projection).sort("_id", pymongo.ASCENDING).limit(chunk_size))
+        if not chunk:
+            return count
+        last_id = chunk[-1]["_id"]
+
+        by_fp = dict((url_fingerprint(url_doc["url"]), url_doc) for url_doc in chunk)
+        stored = dict((content["_id"], content) for content in
+                      content_collection.find({"_id" : {"$in" : by_fp.keys()}}, dict((field, 1) for field in CONTENT_FIELDS)))
+
+        bulk = content_collection.initialize_unordered_bulk_op()
+        has_content = False
+        for fp, url_doc in by_fp.items():
+            content = dict((field, url_doc[field]) for field in CONTENT_FIELDS
+                           if field in url_doc and field not in stored.get(fp, {}))
+            if content:
+                url_doc.setdefault("host", url_host(url_doc["url"]))
+                bulk.find({"_id" : fp}).upsert().update_one({"$set" : make_content_doc(url_doc, content)})
+                has_content = True
+        if has_content:
+            bulk.execute()
+
+        urlinfo_collection.update({"_id" : {"$in" : [url_doc["_id"] for url_doc in chunk]}},
+                                  {"$unset" : dict((field, "") for field in CONTENT_FIELDS)}, multi=True)
+        count += len(chunk)
+
+
+def url_fingerprint(url):
+    if isinstance(url, unicode):
+        url = url.encode("utf8")
+    return hashlib.sha1(url).hexdigest()
+
+
+def _as_score(score):
+    """Scores set through the UI may arrive as strings, missing scores count as 0"""
+
+    try:
+        return float(score)
+    except (TypeError, ValueError):
+        return 0.0
+
 
 class MemexMongoUtils(object):
 
@@ -24,12 +261,18 @@ class MemexMongoUtils(object):
         to connect to common crawl specify this as cc-crawldata
         """
 
-        self.client = MongoClient(address, port)
-        
+        self.client = get_client(address, port)
+
         db = self.client["MemexHack"]
 
         workspace_collection_name = "workspace"
         self.workspace_collection = db[workspace_collection_name]
+        self.jobs_collection = db["jobs"]
+        self.changes_collection = db["changes"]
+        self.which_collection = which_collection
+        self.workspace_name = None
+        self.last_bump = 0.0
+        self.bump_due = False
 
         seed_collection_name = "seedinfo"
         cf_collection_name = "cfinfo"
@@ -37,21 +280,25 @@ class MemexMongoUtils(object):
         if which_collection == "cc-crawl-data":
             url_collection_name = "cc-urlinfo"
             host_collection_name = "cc-hostinfo"
+            content_collection_name = "cc-contentinfo"
         elif which_collection == "known-data":
             url_collection_name = "known-urlsinfo"
             host_collection_name = "known-hostsinfo"
+            content_collection_name = "known-contentinfo"
         elif which_collection == "crawl-data":
             # Search for the current selected workspace
             # if empty leave the default
-            ws_doc = self.workspace_collection.find_one({"selected" : True})
-            if None == ws_doc:
+            ws_name = self.workspace_name = self._get_selected_workspace_name()
+            if None == ws_name:
                 url_collection_name = "urlinfo"
                 host_collection_name = "hostinfo"
+                content_collection_name = "contentinfo"
             else:
-                url_collection_name = "urlinfo" + "-" + ws_doc['name']
-                host_collection_name = "hostinfo" + "-" + ws_doc['name']
-                seed_collection_name = "seedinfo" + "-" + ws_doc['name']
-                cf_collection_name = "cfinfo" + "-" + ws_doc['name']
+                url_collection_name = "urlinfo" + "-" + ws_name
+                host_collection_name = "hostinfo" + "-" + ws_name
+                seed_collection_name = "seedinfo" + "-" + ws_name
+                cf_collection_name = "cfinfo" + "-" + ws_name
+                content_collection_name = "contentinfo" + "-" + ws_name
         else:
             raise Exception("You have specified an invalid collection, please choose either crawl-data or cc-crawl-data for which_collection")
 
@@ -59,6 +306,7 @@ class MemexMongoUtils(object):
         self.hostinfo_collection = db[host_collection_name]
         self.seed_collection = db[seed_collection_name]
         self.cf_collection = db[cf_collection_name]
+        self.content_collection = db[content_collection_name]
 
         if init_db:
             print "Got call to initialize db with %s %s" % (url_collection_name, host_collection_name)
@@ -68,6 +316,7 @@ class MemexMongoUtils(object):
                 db.drop_collection(host_collection_name)
                 db.drop_collection(seed_collection_name)
                 db.drop_collection(cf_collection_name)
+                db.drop_collection(content_collection_name)
 
             except:
                 print "handled:"
@@ -77,14 +326,31 @@ class MemexMongoUtils(object):
             db.create_collection(host_collection_name)
             db.create_collection(seed_collection_name)
             db.create_collection(cf_collection_name)
+            db.create_collection(content_collection_name)
 
             # create index and drop any dupes
-            self.urlinfo_collection.ensure_index("url", unique=True, drop_dups=True)
-            self.hostinfo_collection.ensure_index("host", unique=True, drop_dups=True)
+            ensure_url_indexes(self.urlinfo_collection)
+            ensure_host_indexes(self.hostinfo_collection)
             self.seed_collection.ensure_index("url", unique=True, drop_dups=True)
-            self.hostinfo_collection.ensure_index("host_score")
             self.cf_collection.ensure_index("meta.fingerprint", unique=True, drop_dups=True)
             self.cf_collection.ensure_index("score")
+            ensure_content_indexes(self.content_collection)
+            self.bump_changes()
+
+    def _get_selected_workspace_name(self):
+        """Name of the selected workspace, read from mongo once per workspace scope (see
+        begin_workspace_scope) and every time outside of one, as any process may change it"""
+
+        scoped = getattr(_workspace_scope, "active", False)
+        if scoped and _workspace_scope.resolved:
+            return _workspace_scope.name
+
+        ws_doc = self.workspace_collection.find_one({"selected" : True}, {"name" : 1})
+        name = ws_doc["name"] if ws_doc else None
+        if scoped:
+            _workspace_scope.name = name
+            _workspace_scope.resolved = True
+        return name
 
     def init_workspace(self, address="mongodb", port=27017):
         db = self.client["MemexHack"]
@@ -97,6 +363,7 @@ class MemexMongoUtils(object):
         
         print "Dropping %s" % (workspace_collection_name)
         db.drop_collection(workspace_collection_name)
+        _forget_selected_workspace()
         db.create_collection(workspace_collection_name)
         self.add_workspace("default")
         self.set_workspace_selected_by_name("default")
@@ -105,26 +372,44 @@ class MemexMongoUtils(object):
         
         return self.hostinfo_collection.index_information()
 
-    def list_urls(self, host=None, limit=20):
+    def list_urls(self, host=None, limit=20, fields=None):
+
+        return list(self.find_urls(host=host, limit=limit, fields=fields))
 
+    def find_urls(self, host=None, limit=20, fields=None, batch_size=100):
+        """Cursor over the best scoring urls (of host), fields limits the returned fields"""
+
+        projection = dict((field, 1) for field in fields) if fields is not None else None
         if not host:
-            docs = self.urlinfo_collection.find({ "display": { "$ne": 0 } }).sort("score", -1).limit(limit)
+            docs = self.urlinfo_collection.find({ "display": { "$ne": 0 } }, projection).sort("score", -1).limit(limit)
         else:
-            docs = self.urlinfo_collection.find({"host" : host}).sort("score", -1).limit(limit)
+            docs = self.urlinfo_collection.find({"host" : host}, projection).sort("score", -1).limit(limit)
 
-        return list(docs)
+        return docs.batch_size(batch_size)
+
+    def get_url(self, url, return_html=False):
+        """Url document with all its fields, page bodies included when return_html is set"""
 
-    def list_hosts(self, page=1, page_size=10, filter_regex = None, filter_field = None, show_all=None):
+        url_doc = self.urlinfo_collection.find_one({"url" : url})
+        if url_doc and return_html:
+            url_doc.update(self.get_content(url))
+        return url_doc
+
+    def list_hosts(self, page=1, page_size=10, filter_regex = None, filter_field = None, show_all=None, after=None):
+        """List a page of hosts. When after, a token from encode_page_token, is given the page starts
+        right after that host and page is ignored, which keeps deep pages as cheap as the first one.
+        """
 
         if filter_regex and filter_field:
-            docs = self.get_hosts_filtered(filter_field = filter_field, filter_regex = filter_regex, show_all=show_all)
+            docs = self.get_hosts_filtered(filter_field = filter_field, filter_regex = filter_regex, show_all=show_all, after=after)
         else:
-            docs = self.get_hosts(show_all=show_all)
+            docs = self.get_hosts(show_all=show_all, after=after)
 
-        try:
-            docs = docs.skip(page_size * (page - 1)).limit(page_size)
-        except Exception:
-            docs = docs.limit(page_size)
+        if after is None:
+            try:
+                docs = docs.skip(page_size * (page - 1)).limit(page_size)
+            except Exception:
+                docs = docs.limit(page_size)
 
         docs_list = list(docs.limit(page_size))
 
@@ -137,22 +422,45 @@ class MemexMongoUtils(object):
 
     def list_all_urls(self, sort_by="host", return_html = False, list_deleted = False):
 
-        if list_deleted:
-            docs = self.urlinfo_collection.find({}, {'html':int(return_html), 'html_rendered': int(return_html)})  # .sort(sort_by, 1)
-        else:
-            docs = self.urlinfo_collection.find({ "display": { "$ne": 0 } }, {'html':int(return_html), 'html_rendered': int(return_html)})  # .sort(sort_by, 1)
+        return list(self.iter_urls(sort_by=sort_by, return_html=return_html, list_deleted=list_deleted))
+
+    def iter_urls(self, sort_by="host", fields=None, query=None, return_html = False, list_deleted = False, batch_size=1000):
+        """Stream url documents sorted by mongo, holding at most one batch in memory.
 
-        return sorted(list(docs), key=lambda rec: rec[sort_by])
+        fields limits the returned fields (e.g. ["url", "host", "screenshot_path"]), query narrows the urls.
+        Sorting by _id, url or host is backed by an index, the host one being created for older
+        collections by migrate.py.
+        """
+
+        projection = dict((field, 1) for field in fields) if fields is not None else None
+
+        query = dict(query or {})
+        if not list_deleted:
+            query["display"] = { "$ne": 0 }
+
+        docs = self.urlinfo_collection.find(query, projection).sort(sort_by, 1).batch_size(batch_size)
+        if return_html:
+            return self._iter_with_content(docs, batch_size)
+        return docs
     
-    def list_all_urls_iterator(self, return_html):
+    def list_all_urls_iterator(self, return_html, batch_size=500):
         
-        docs = self.urlinfo_collection.find({}, {'url':int(True), 'html':int(return_html), 'html_rendered': int(return_html)})  # .sort(sort_by, 1)
-        return docs        
+        if return_html:
+            docs = self.urlinfo_collection.find({}, {'url' : 1})  # .sort(sort_by, 1)
+            return self._iter_with_content(docs, batch_size)
+        else:
+            return self.urlinfo_collection.find({}, {'url' : 1})
 
     def list_all_urls_with_interest(self, interest, return_html = False):
 
-        docs = self.urlinfo_collection.find({"interest": interest}, {"html": int(return_html)})
-        return list(docs)
+        docs = list(self.urlinfo_collection.find({"interest": interest}))
+        if return_html:
+            self.attach_content(docs)
+        return docs
+
+    def count_urls_with_interest(self, interest):
+
+        return self.urlinfo_collection.find({"interest": interest}).count()
 
     def list_seeds(self, sort_by="url"):
 
@@ -182,29 +490,183 @@ class MemexMongoUtils(object):
     def insert_url(self, **kwargs):
         '''
         Inserts a URL and properly increments the needed host document. If URL already exists, it will be skipped.
+        Returns True if the URL was new. The change counter is bumped at most every INSERT_BUMP_INTERVAL
+        seconds, call flush_changes once done inserting.
         
         is_seed,crawled_at,title,url,link_url,link_text,html_rendered,referrer_depth,depth,total_depth,host,referrer_url,html        
         '''
 
-        url = kwargs["url"]
-        extracted = extract_tld(url)
-        host = extracted.domain + '.' + extracted.suffix
+        return self.insert_urls([kwargs], bump_interval=INSERT_BUMP_INTERVAL) == 1
+
+    def insert_urls(self, url_docs, bump_interval=0):
+        """Bulk version of insert_url for a batch of url documents, returns how many urls were new.
+
+        Page bodies go out first as one unordered bulk of upserts keyed by url fingerprint, then the
+        urls as one bulk of upserts that only write new urls, flagged pending. The host counters and
+        best screenshots of pending urls are then brought up to date and the flag dropped. Every step
+        can be repeated, so a batch that failed half way can be inserted again as it is and the urls
+        stored by the first attempt are finished rather than skipped. The change counter is bumped once
+        per batch, or held back as in bump_changes_throttled when bump_interval is given.
+        """
+
+        if not url_docs:
+            return 0
+
+        content_bulk = self.content_collection.initialize_unordered_bulk_op()
+        url_bulk = self.urlinfo_collection.initialize_unordered_bulk_op()
+        has_content = False
+        urls = []
+        for url_doc in url_docs:
+            url_doc = dict(url_doc)
+            url_doc["host"] = url_host(url_doc["url"])
+            content = dict((field, url_doc.pop(field)) for field in CONTENT_FIELDS if field in url_doc)
+            if content:
+                # bodies of urls stored before are left alone, like the url documents themselves
+                content_bulk.find({"_id" : url_fingerprint(url_doc["url"])}).upsert().update_one({"$setOnInsert" : make_content_doc(url_doc, content)})
+                has_content = True
+            url_doc["pending"] = True
+            url_bulk.find({"url" : url_doc["url"]}).upsert().update_one({"$setOnInsert" : url_doc})
+            urls.append(url_doc["url"])
+
+        if has_content:
+            try:
+                content_bulk.execute()
+            except BulkWriteError as e:
+                if not _duplicate_keys_only(e):
+                    raise
 
-        url_doc = kwargs
-        url_doc["host"] = host
-        
         try:
-            self.urlinfo_collection.save(kwargs)
-        except DuplicateKeyError:
-            pass
+            res = url_bulk.execute()
+        except BulkWriteError as e:
+            # concurrent upserts of one url can race on the unique index, the url exists either way
+            if not _duplicate_keys_only(e):
+                raise
+            res = e.details
+
+        # urls new to this batch and the ones a failed earlier attempt left pending
+        pending = list(self.urlinfo_collection.find({"url" : {"$in" : urls}, "pending" : True},
+                                                    {"url" : 1, "host" : 1, "score" : 1, "screenshot_path" : 1}))
+        if pending:
+            self._refresh_num_urls(set(url_doc["host"] for url_doc in pending))
+
+            best = {}
+            for url_doc in pending:
+                host = url_doc["host"]
+                if url_doc.get("screenshot_path") and _as_score(url_doc.get("score")) >= _as_score(best.get(host, {}).get("score")):
+                    best[host] = url_doc
+            for host, url_doc in best.items():
+                self._update_best_screenshot(host, url_doc["url"], url_doc.get("score"), url_doc["screenshot_path"])
+
+            self.urlinfo_collection.update({"url" : {"$in" : [url_doc["url"] for url_doc in pending]}},
+                                           {"$unset" : {"pending" : ""}}, multi=True)
+            self.bump_changes_throttled(bump_interval)
+
+        return len(res.get("upserted", []))
+
+    def _refresh_num_urls(self, hosts):
+        """Set the hosts' num_urls to the number of urls stored for them, creating missing host documents.
+        Counting instead of incrementing gives the same result however often it runs, each count is
+        answered from the (host, score) index.
+        """
 
-        host_doc = {"host" : host, "num_urls" : 1, "host_score" : None}
+        hosts = list(hosts)
+        counts = dict((host, self.urlinfo_collection.find({"host" : host}).count()) for host in hosts)
 
-        #try to insert a new host doc, if fail increment url count
+        host_bulk = self.hostinfo_collection.initialize_unordered_bulk_op()
+        for host in hosts:
+            host_bulk.find({"host" : host}).upsert().update_one({"$setOnInsert" : {"host_score" : None, "host_keys" : host_search_keys(host)},
+                                                                "$set" : {"num_urls" : counts[host]}})
         try:
-            self.hostinfo_collection.save(host_doc)
-        except DuplicateKeyError:
-            self.hostinfo_collection.update({"host" : host}, {"$inc" : {"num_urls" : 1}})
+            host_bulk.execute()
+        except BulkWriteError as e:
+            # lost an upsert race with another writer, the host document exists now so just set the count
+            if not _duplicate_keys_only(e):
+                raise
+            for error in e.details["writeErrors"]:
+                host = hosts[error["index"]]
+                self.hostinfo_collection.update({"host" : host}, {"$set" : {"num_urls" : counts[host]}})
+
+    ############# CONTENT #############
+
+    def _save_content(self, url_doc, content):
+        """Store the page bodies of url_doc in the content collection"""
+
+        if not content:
+            return
+        self.content_collection.update({"_id" : url_fingerprint(url_doc["url"])}, {"$set" : make_content_doc(url_doc, content)}, upsert=True)
+
+    def get_content(self, url):
+        """Page bodies of url, {} if none are stored"""
+
+        content = self.content_collection.find_one({"_id" : url_fingerprint(url)}) or {}
+        return dict((field, decompress_html(content[field])) for field in CONTENT_FIELDS if field in content)
+
+    def attach_texts(self, url_docs, text_version):
+        """Fill content_hash, the digest of the body the ranker reads (html_rendered, else html), into
+        url_docs and text where the stored text was extracted from that body by extractor text_version.
+        One query for the batch, the bodies themselves aren't loaded.
+        """
+
+        by_fp = {}
+        for url_doc in url_docs:
+            url_doc["content_hash"] = None
+            by_fp[url_fingerprint(url_doc["url"])] = url_doc
+        if not by_fp:
+            return url_docs
+
+        projection = {"text" : 1, "text_source" : 1, "text_version" : 1, "html_hash" : 1, "html_rendered_hash" : 1}
+        for content in self.content_collection.find({"_id" : {"$in" : by_fp.keys()}}, projection):
+            url_doc = by_fp[content["_id"]]
+            url_doc["content_hash"] = content.get("html_rendered_hash") or content.get("html_hash")
+            if "text" in content and content.get("text_source") == url_doc["content_hash"] \
+                    and content.get("text_version") == text_version:
+                url_doc["text"] = decompress_html(content["text"])
+
+        return url_docs
+
+    def save_texts(self, texts, text_version):
+        """Store (url_doc, text) texts extracted by extractor text_version next to the bodies they came
+        from (url_doc's content_hash, see attach_texts), with one unordered bulk write"""
+
+        if not texts:
+            return
+
+        bulk = self.content_collection.initialize_unordered_bulk_op()
+        for url_doc, text in texts:
+            fields = {"url" : url_doc["url"], "text" : compress_html(text), "text_hash" : html_digest(text),
+                      "text_source" : url_doc.get("content_hash"), "text_version" : text_version}
+            if url_doc.get("host"):
+                fields["host"] = url_doc["host"]
+            bulk.find({"_id" : url_fingerprint(url_doc["url"])}).upsert().update_one({"$set" : fields})
+        bulk.execute()
+
+    def attach_content(self, url_docs, fields=CONTENT_FIELDS):
+        """Fill the page bodies into url_docs with one query for the whole batch"""
+
+        by_fp = dict((url_fingerprint(url_doc["url"]), url_doc) for url_doc in url_docs)
+        if not by_fp:
+            return url_docs
+
+        projection = dict((field, 1) for field in fields)
+        for content in self.content_collection.find({"_id" : {"$in" : by_fp.keys()}}, projection):
+            url_doc = by_fp[content["_id"]]
+            for field in fields:
+                if field in content:
+                    url_doc[field] = decompress_html(content[field])
+
+        return url_docs
+
+    def _iter_with_content(self, docs, batch_size):
+        batch = []
+        for doc in docs:
+            batch.append(doc)
+            if len(batch) == batch_size:
+                for url_doc in self.attach_content(batch):
+                    yield url_doc
+                batch = []
+
+        for url_doc in self.attach_content(batch):
+            yield url_doc
 
     def get_host_score(self, host):
 
@@ -247,6 +709,71 @@ class MemexMongoUtils(object):
         else:
             return None
 
+    def get_highest_scoring_urls_with_screenshot(self, hosts):
+        """Return {host : url_doc} with the best scoring screenshotted url of each host.
+
+        Done in a single aggregation so a page of hosts costs one round-trip, only the fields
+        needed to build a host card are returned (never the html).
+        """
+
+        if not hosts:
+            return {}
+
+        pipeline = [
+            {"$match" : {"host" : {"$in" : list(hosts)}, "screenshot_path" : {"$exists" : True}}},
+            {"$project" : {"_id" : 0, "host" : 1, "url" : 1, "score" : 1, "screenshot_path" : 1}},
+            {"$sort" : {"host" : 1, "score" : -1}},
+            {"$group" : {"_id" : "$host",
+                         "url" : {"$first" : "$url"},
+                         "score" : {"$first" : "$score"},
+                         "screenshot_path" : {"$first" : "$screenshot_path"}}},
+        ]
+        res = self.urlinfo_collection.aggregate(pipeline)
+
+        best_urls = {}
+        for doc in res["result"]:
+            host = doc.pop("_id")
+            doc["host"] = host
+            if doc.get("score") is None:
+                doc["score"] = 0
+            best_urls[host] = doc
+
+        return best_urls
+
+    def _update_best_screenshot(self, host, url, score, screenshot_path):
+        """Point the host document at url if it beats the host's current best screenshot.
+
+        The best_* fields let host grids be served from hostinfo alone. The update is conditional
+        on best_score so concurrent writers can only ever move the pointer up.
+        """
+
+        score = _as_score(score)
+        res = self.hostinfo_collection.update(
+            {"host" : host, "$or" : [{"best_score" : {"$lt" : score}}, {"best_score" : None}]},
+            {"$set" : {"best_url" : url, "best_score" : score, "best_screenshot_path" : screenshot_path}})
+
+        if not res["n"]:
+            # url may already be the best one, a lower score can then hand the spot to another url
+            if self.hostinfo_collection.find_one({"host" : host, "best_url" : url, "best_score" : {"$ne" : score}}, {"_id" : 1}):
+                self.refresh_best_screenshots([host])
+            else:
+                # same best url and score, its screenshot may have been retaken
+                self.hostinfo_collection.update({"host" : host, "best_url" : url, "best_screenshot_path" : {"$ne" : screenshot_path}},
+                                                {"$set" : {"best_screenshot_path" : screenshot_path}})
+
+    def refresh_best_screenshots(self, hosts):
+        """Recompute best_url, best_score and best_screenshot_path of hosts from their urls"""
+
+        best_urls = self.get_highest_scoring_urls_with_screenshot(hosts)
+        for host in hosts:
+            hsu = best_urls.get(host)
+            if hsu:
+                self.hostinfo_collection.update({"host" : host}, {"$set" : {"best_url" : hsu["url"],
+                                                                            "best_score" : _as_score(hsu["score"]),
+                                                                            "best_screenshot_path" : hsu["screenshot_path"]}})
+            else:
+                self.hostinfo_collection.update({"host" : host}, {"$unset" : {"best_url" : "", "best_score" : "", "best_screenshot_path" : ""}})
+
     def get_seed_doc(self, url):
 
         seed_doc = self.seed_collection.find_one({"url" : url})
@@ -254,57 +781,169 @@ class MemexMongoUtils(object):
 
     def set_interest(self, url, interest):
 
-        self.urlinfo_collection.update({"url" : url}, {'$set' : {"interest" : interest}})
+        # a new label has to be learned again by models updated with partial_fit, see mark_learned
+        self.urlinfo_collection.update({"url" : url}, {'$set' : {"interest" : interest}, '$unset' : {"learned" : ""}})
+        self.bump_changes()
+
+    def mark_learned(self, urls, interests, chunk_size=1000):
+        """Flag urls as learned by the ranker, interests being the labels it learned them with. Urls
+        relabelled in the meantime keep their flag unset so the new label gets learned too.
+        """
+
+        by_interest = {}
+        for url, interest in itertools.izip(urls, interests):
+            by_interest.setdefault(interest, []).append(url)
 
-    def set_score(self, url, score_set):
+        for interest, interest_urls in by_interest.iteritems():
+            for i in xrange(0, len(interest_urls), chunk_size):
+                self.urlinfo_collection.update({"url" : {"$in" : interest_urls[i:i + chunk_size]}, "interest" : interest},
+                                               {'$set' : {"learned" : True}}, multi=True)
+
+    def set_score(self, url, score_set, update_host=True):
+        """Set the score of url. With update_host the host's best screenshot pointer follows along,
+        bulk rescoring turns it off and calls refresh_best_screenshots once per host instead.
+        """
 
         self.urlinfo_collection.update({"url" : url}, {'$set' : {"score" : score_set}})
 
+        if update_host:
+            url_doc = self.urlinfo_collection.find_one({"url" : url}, {"host" : 1, "screenshot_path" : 1})
+            if url_doc and url_doc.get("screenshot_path"):
+                self._update_best_screenshot(url_doc["host"], url, score_set, url_doc["screenshot_path"])
+
+        self.bump_changes()
+
+    def set_scores(self, scores, model_version=None):
+        """Set many url scores with one unordered bulk update, scores being (url, score, content_hash)
+        tuples. The model version and content hash are kept to tell later whether a rescore would
+        change anything. Hosts' best screenshots are left to refresh_best_screenshots.
+        """
+
+        if not scores:
+            return
+
+        bulk = self.urlinfo_collection.initialize_unordered_bulk_op()
+        for url, score, content_hash in scores:
+            bulk.find({"url" : url}).update_one({'$set' : {"score" : score, "score_model" : model_version, "score_content" : content_hash}})
+        bulk.execute()
+        self.bump_changes()
+
+    def refresh_host_scores(self, chunk_size=1000):
+        """Set the host_score of every host with urls to their highest score (0 if none is scored), with
+        one aggregation and unordered bulk writes of chunk_size hosts, counted as a single change
+        """
+
+        res = self.urlinfo_collection.aggregate([{"$group" : {"_id" : "$host", "score" : {"$max" : "$score"}}}])
+
+        bulk = None
+        pending = 0
+        for doc in res["result"]:
+            if bulk is None:
+                bulk = self.hostinfo_collection.initialize_unordered_bulk_op()
+            bulk.find({"host" : doc["_id"]}).update_one({"$set" : {"host_score" : _as_score(doc["score"])}})
+            pending += 1
+            if pending == chunk_size:
+                bulk.execute()
+                bulk = None
+                pending = 0
+        if pending:
+            bulk.execute()
+
+        self.bump_changes()
+
     def set_host_score(self, host, score_set):
 
         self.hostinfo_collection.update({"host" : host}, {'$set' : {"host_score" : score_set}})
+        self.bump_changes()
         
     def set_screenshot_path(self, url, screenshot_path):
 
-        self.urlinfo_collection.update({"url" : url}, {'$set' : {"screenshot_path" : screenshot_path}})        
+        self.urlinfo_collection.update({"url" : url}, {'$set' : {"screenshot_path" : screenshot_path}})
+        url_doc = self.urlinfo_collection.find_one({"url" : url}, {"host" : 1, "score" : 1})
+        if url_doc:
+            self._update_best_screenshot(url_doc["host"], url, url_doc.get("score"), screenshot_path)
+        self.bump_changes()
 
     def set_html_rendered(self, url, html_rendered):
 
-        self.urlinfo_collection.update({"url" : url}, {'$set' : {"html_rendered" : html_rendered}})
+        url_doc = self.urlinfo_collection.find_one({"url" : url}, {"url" : 1, "host" : 1})
+        if url_doc:
+            self._save_content(url_doc, {"html_rendered" : html_rendered})
 
-    def delete_urls_by_match(self, match, negative_match = False):
-        """Remove hosts and urls by matching URLs"""
+    def _match_query(self, field, match, negative_match):
+        """Query for documents whose field does (or with negative_match doesn't) contain match"""
 
-        url_dics = self.list_all_urls()
-        for url_dic in url_dics:
-            if negative_match:
-                if not match in url_dic["url"]:                    
-                    self.hostinfo_collection.remove({"host" : url_dic["host"]})
-                    self.urlinfo_collection.remove({"url" : url_dic["url"]})
-            else:
-                if match in url_dic["url"]:
-                    self.hostinfo_collection.remove({"host" : url_dic["host"]})
-                    self.urlinfo_collection.remove({"url" : url_dic["url"]})
-
-    def delete_hosts_by_match(self, match, negative_match = False):
-        """Remove hosts and urls by matching hosts"""
-
-        host_dics = self.list_all_hosts()
-        for host_dic in host_dics:
-            if negative_match:
-                if not match in host_dic["host"]:                    
-                    self.hostinfo_collection.remove({"host" : host_dic["host"]})
-                    self.urlinfo_collection.remove({"host" : host_dic["host"]})
-            else:
-                if match in host_dic["host"]:
-                    self.hostinfo_collection.remove({"host" : host_dic["host"]})
-                    self.urlinfo_collection.remove({"host" : host_dic["host"]})
+        pattern = re.compile(re.escape(match))
+        if negative_match:
+            return {field : {"$not" : pattern}, "display" : {"$ne" : 0}}
+        else:
+            return {field : pattern, "display" : {"$ne" : 0}}
+
+    def delete_urls_by_match(self, match, negative_match = False, progress = None, chunk_size = 1000):
+        """Remove hosts and urls by matching URLs, returns the deleted counts.
+
+        Matching urls are read a chunk at a time (url and host only) and removed with indexed $in deletes,
+        progress, if given, is called with the running counts after each chunk.
+        """
+
+        deleted = {"urls" : 0, "hosts" : 0}
+        hosts = set()
+
+        def remove_chunk(urls):
+            self.content_collection.remove({"_id" : {"$in" : [url_fingerprint(url) for url in urls]}})
+            deleted["urls"] += self.urlinfo_collection.remove({"url" : {"$in" : urls}})["n"]
+            self.bump_changes()
+            if progress:
+                progress(**deleted)
+
+        urls = []
+        for url_dic in self.urlinfo_collection.find(self._match_query("url", match, negative_match), {"url" : 1, "host" : 1}):
+            urls.append(url_dic["url"])
+            hosts.add(url_dic["host"])
+            if len(urls) == chunk_size:
+                remove_chunk(urls)
+                urls = []
+        if urls:
+            remove_chunk(urls)
+
+        hosts = list(hosts)
+        for i in xrange(0, len(hosts), chunk_size):
+            deleted["hosts"] += self.hostinfo_collection.remove({"host" : {"$in" : hosts[i:i + chunk_size]}})["n"]
+            self.bump_changes()
+            if progress:
+                progress(**deleted)
+
+        return deleted
+
+    def delete_hosts_by_match(self, match, negative_match = False, progress = None, chunk_size = 1000):
+        """Remove hosts and urls by matching hosts, returns the deleted counts"""
+
+        deleted = {"urls" : 0, "hosts" : 0}
+
+        def remove_chunk(hosts):
+            self.content_collection.remove({"host" : {"$in" : hosts}})
+            deleted["urls"] += self.urlinfo_collection.remove({"host" : {"$in" : hosts}})["n"]
+            deleted["hosts"] += self.hostinfo_collection.remove({"host" : {"$in" : hosts}})["n"]
+            self.bump_changes()
+            if progress:
+                progress(**deleted)
+
+        hosts = [host_dic["host"] for host_dic in self.hostinfo_collection.find(self._match_query("host", match, negative_match), {"host" : 1})]
+        for i in xrange(0, len(hosts), chunk_size):
+            remove_chunk(hosts[i:i + chunk_size])
 
-    def delete_all_by_match(self, match, negative_match = False):
-        """Remove hosts and urls by matching both urls and hosts"""
+        return deleted
 
-        self.delete_urls_by_match(match, negative_match = negative_match)
-        self.delete_hosts_by_match(match, negative_match = negative_match)
+    def delete_all_by_match(self, match, negative_match = False, progress = None):
+        """Remove hosts and urls by matching both urls and hosts, returns the deleted counts"""
+
+        by_url = self.delete_urls_by_match(match, negative_match = negative_match, progress = progress)
+
+        def host_progress(urls, hosts):
+            progress(urls = by_url["urls"] + urls, hosts = by_url["hosts"] + hosts)
+
+        by_host = self.delete_hosts_by_match(match, negative_match = negative_match, progress = host_progress if progress else None)
+        return {"urls" : by_url["urls"] + by_host["urls"], "hosts" : by_url["hosts"] + by_host["hosts"]}
 
     #####################   workspace  #####################
 
@@ -319,18 +958,22 @@ class MemexMongoUtils(object):
         host_collection_name = "hostinfo" + "-" + name
         seed_collection_name = "seedinfo" + "-" + name
         cf_collection_name = "cfinfo" + "-" + name
+        content_collection_name = "contentinfo" + "-" + name
 
         db = self.client["MemexHack"]
         db.create_collection(url_collection_name)
         db.create_collection(host_collection_name)
         db.create_collection(seed_collection_name)
         db.create_collection(cf_collection_name)
+        db.create_collection(content_collection_name)
 
         # create index and drop any dupes
-        db[url_collection_name].ensure_index("url", unique=True, drop_dups=True)
-        db[host_collection_name].ensure_index("host", unique=True, drop_dups=True)
+        ensure_url_indexes(db[url_collection_name])
+        ensure_host_indexes(db[host_collection_name])
         db[seed_collection_name].ensure_index("url", unique=True, drop_dups=True)
         db[cf_collection_name].ensure_index("meta.fingerprint", unique=True, drop_dups=True)
+        ensure_content_indexes(db[content_collection_name])
+        self.bump_changes(everywhere=True)
 
     def get_workspace_by_id(self,id):
         return self.workspace_collection.find_one({"_id" : ObjectId( id )})
@@ -338,10 +981,14 @@ class MemexMongoUtils(object):
     def set_workspace_selected_by_name(self, name):
         self.workspace_collection.update({}, {'$set' : {"selected" : False}}, multi=True)
         self.workspace_collection.update({"name" : name}, {'$set' : {"selected" : True}})
+        _forget_selected_workspace()
+        self.bump_changes(everywhere=True)
 
     def set_workspace_selected(self, id):
         self.workspace_collection.update({}, {'$set' : {"selected" : False}}, multi=True)
         self.workspace_collection.update({"_id" : ObjectId( id )}, {'$set' : {"selected" : True}})
+        _forget_selected_workspace()
+        self.bump_changes(everywhere=True)
 
     def get_workspace_selected(self):
         return self.workspace_collection.find_one({"selected" : True})
@@ -353,6 +1000,7 @@ class MemexMongoUtils(object):
         else:
             self.delete_workspace_related(ws_doc['name'])
             self.workspace_collection.remove({"_id" : ObjectId( id )})
+            self.bump_changes(everywhere=True)
 
     def delete_workspace_related(self,name):
         db = self.client["MemexHack"]
@@ -364,6 +1012,8 @@ class MemexMongoUtils(object):
         db["seedinfo" + "-" + name].drop()
         print "Dropping %s" % ("cfinfo" + "-" + name)
         db["cfinfo" + "-" + name].drop()
+        print "Dropping %s" % ("contentinfo" + "-" + name)
+        db["contentinfo" + "-" + name].drop()
 
     #####################   keyword  #####################
     def list_keyword(self):
@@ -380,6 +1030,7 @@ class MemexMongoUtils(object):
             self.workspace_collection.upsert({"_id" : "_default"}, {'$set' : {"keyword" : keywords}})
         else:
             self.workspace_collection.update({"_id" : ObjectId(ws["_id"] )}, {'$set' : {"keyword" : keywords}})
+        self.bump_changes(everywhere=True)
 
     ####################   search term  #####################
     def list_search_term(self):
@@ -397,27 +1048,75 @@ class MemexMongoUtils(object):
             self.workspace_collection.upsert({"_id" : "_default"}, {'$set' : {"searchterm" : search_terms}})
         else:
             self.workspace_collection.update({"_id" : ObjectId(ws["_id"] )}, {'$set' : {"searchterm" : search_terms}})
+        self.bump_changes(everywhere=True)
 
     ############# HOST HELPERS ###########
 
-    def get_hosts(self, show_all=None):
+    def _hosts_query(self, filter_field=None, filter_regex=None, show_all=None):
+        """Query of the host listing, with the compiled filter (see filters.compile_filter) or None"""
+
+        clauses = []
+        compiled = None
+        if filter_field and filter_regex:
+            compiled = compile_filter(filter_field, filter_regex)
+            clauses.append(compiled["query"])
+        if not show_all:
+            clauses.append({ "display": { "$ne": 0 }})
+
+        if clauses:
+            return {'$and' : clauses}, compiled
+        else:
+            return {}, compiled
+
+    def _limit_time(self, cursor, compiled):
+        if compiled and compiled["max_time_ms"]:
+            cursor = cursor.max_time_ms(compiled["max_time_ms"])
+        return cursor
+
+    def explain_hosts_filter(self, filter_field, filter_regex, show_all=None):
+        """How a host filter gets compiled and what mongo makes of it, for debugging slow filters"""
+
+        query, compiled = self._hosts_query(filter_field=filter_field, filter_regex=filter_regex, show_all=show_all)
+        sort_order = [("host_score", pymongo.DESCENDING),("_id", pymongo.ASCENDING)]
+        cursor = self._limit_time(self.hostinfo_collection.find(query).sort(sort_order), compiled)
+        return {"plan" : compiled["plan"], "query" : query, "explain" : cursor.explain()}
+
+    def get_host_rank(self, host, filter_field=None, filter_regex=None, show_all=None):
+        """Position of host in the (filtered) host listing, None if the listing doesn't contain it.
+
+        Counts the hosts sorting before it, which the (host_score, _id) index answers without
+        walking the listing.
+        """
+
+        query, compiled = self._hosts_query(filter_field=filter_field, filter_regex=filter_regex, show_all=show_all)
+        host_doc = self._limit_time(self.hostinfo_collection.find({'$and' : [query, {"host" : host}]}, {"host_score" : 1}), compiled).limit(1)
+        host_doc = next(iter(host_doc), None)
+        if host_doc is None:
+            return None
+
+        return self._limit_time(self.hostinfo_collection.find({'$and' : [query, _before_host(host_doc)]}), compiled).count()
+
+    def get_hosts(self, show_all=None, after=None):
         if show_all:
             query = {}
         else:
             query = { "display": { "$ne": 0 } }
 
+        if after is not None:
+            query = {'$and' : [query, _after_page_token(after)]}
+
         sort_order = [("host_score", pymongo.DESCENDING),("_id", pymongo.ASCENDING)]
         docs = self.hostinfo_collection.find(query).sort(sort_order) # sort by _id to have deterministic results
         return docs
 
-    def get_hosts_filtered(self, filter_field, filter_regex, show_all=None):
-        if show_all:
-            query = {'$and' : [{'$or':[{filter_field:{'$regex':filter_regex}},{"tags":{'$regex':filter_regex}}]}]}
-        else:
-            query = {'$and' : [{'$or':[{filter_field:{'$regex':filter_regex}},{"tags":{'$regex':filter_regex}}]}, { "display": { "$ne": 0 }}]}
+    def get_hosts_filtered(self, filter_field, filter_regex, show_all=None, after=None):
+        query, compiled = self._hosts_query(filter_field=filter_field, filter_regex=filter_regex, show_all=show_all)
+
+        if after is not None:
+            query['$and'].append(_after_page_token(after))
 
         sort_order = [("host_score", pymongo.DESCENDING),("_id", pymongo.ASCENDING)] # sort by _id to have deterministic results
-        docs = self.hostinfo_collection.find(query).sort(sort_order)
+        docs = self._limit_time(self.hostinfo_collection.find(query).sort(sort_order), compiled)
         return docs
 
     def get_hosts_by_tag_match(self, filter_regex, show_all=None):
@@ -445,14 +1144,36 @@ class MemexMongoUtils(object):
     ############# TAGS #############
 
     def save_tags(self, host, tags):
-        self.hostinfo_collection.update({"host" : host}, {'$set' : {"tags" : tags}})
+        self.hostinfo_collection.update({"host" : host}, {'$set' : {"tags" : tags, "tag_keys" : tag_search_keys(tags)}})
+        self.bump_changes()
 
-    def search_tags(self, term):
-        #ws_doc  = self.hostinfo_collection.find({'$or':[{"host":{'$regex':term}},{"tags":{'$regex':term}}]}).sort("host_score", -1)
-        #ws_doc  = self.get_hosts_filtered("host", term)
-        tag_matches = self.get_hosts_by_tag_match(term)
-        host_matches = self.get_hosts_by_host_match(term)
-        ws_doc = {"tag_matches" : list(tag_matches), "host_matches" : list(host_matches)}
+    def _search_hosts(self, keys_field, key, limit):
+        """Hosts with a search key equal to key first, then the ones with a key starting with it.
+        Both lookups are served by the multikey index on keys_field.
+        """
+
+        sort_order = [("host_score", pymongo.DESCENDING),("_id", pymongo.ASCENDING)]
+
+        docs = list(self.hostinfo_collection.find({keys_field : key, "display" : { "$ne": 0 }}).sort(sort_order).limit(limit))
+        if len(docs) < limit:
+            seen = set(doc["_id"] for doc in docs)
+            prefix = {"$regex" : prefix_regex(key)}
+            for doc in self.hostinfo_collection.find({keys_field : prefix, "display" : { "$ne": 0 }}).sort(sort_order).limit(limit + len(docs)):
+                if doc["_id"] not in seen and len(docs) < limit:
+                    docs.append(doc)
+
+        return docs
+
+    def search_tags(self, term, limit=20):
+        """Hosts with a tag or a host name label starting with term (case insensitive), best matches first"""
+
+        key = term.strip().lower()
+        if not key:
+            return None
+
+        tag_matches = self._search_hosts("tag_keys", key, limit)
+        host_matches = self._search_hosts("host_keys", key, limit)
+        ws_doc = {"tag_matches" : tag_matches, "host_matches" : host_matches}
 
         if not tag_matches and not host_matches:
             return None
@@ -469,9 +1190,130 @@ class MemexMongoUtils(object):
     ############# Display Hosts #############
 
     def save_display(self, host, displayable):
-        self.hostinfo_collection.update({"host" : host}, {'$set': {'display': displayable}})
-        self.urlinfo_collection.update({"host" : host}, {'$set': {'display': displayable}}, multi=True)
+        self.save_displays([host], displayable)
+
+    def save_displays(self, hosts, displayable):
+        """Show or hide hosts. Their urls get the same display flag and are marked as (un)interesting,
+        one multi-update per collection no matter how many urls the hosts have.
+        """
+
+        self.hostinfo_collection.update({"host" : {"$in" : hosts}}, {'$set': {'display': displayable}}, multi=True)
+        self.urlinfo_collection.update({"host" : {"$in" : hosts}}, {'$set': {'display': displayable, 'interest': bool(displayable)},
+                                                                   '$unset': {'learned': ''}}, multi=True)
+        self.bump_changes()
+
+
+    ################ CHANGE COUNTERS #########################
+
+    def bump_changes(self, everywhere=False):
+        """Count a change to this url/host collection pair, listings derive their ETags from the counter.
+
+        Known hosts are flagged in every listing, so changes to them (or everywhere) also count as a
+        change to all of them. Counters are never reset, a recreated collection must not reuse old ETags.
+        """
+
+        ids = [self.urlinfo_collection.name]
+        if everywhere or self.which_collection == "known-data":
+            ids.append(ALL_CHANGES)
+        for change_id in ids:
+            self.changes_collection.update({"_id" : change_id}, {"$inc" : {"counter" : 1}}, upsert=True)
+
+    def bump_changes_throttled(self, interval):
+        """bump_changes at most once every interval seconds. A change that comes sooner is held back
+        until a later call past the interval or flush_changes, so a stream of single writes doesn't
+        make every cached listing go stale on each of them.
+        """
+
+        now = time.time()
+        if now - self.last_bump >= interval:
+            self.bump_changes()
+            self.last_bump = now
+            self.bump_due = False
+        else:
+            self.bump_due = True
+
+    def flush_changes(self):
+        """Bump the change counter for changes bump_changes_throttled held back, if any"""
+
+        if self.bump_due:
+            self.bump_changes()
+            self.last_bump = time.time()
+            self.bump_due = False
+
+    def get_change_counter(self, everywhere=False):
+        """Changes seen by this url/host collection pair so far, always increasing. With everywhere
+        only the changes counted everywhere (workspaces, keywords, search terms, blur level)."""
+
+        ids = [ALL_CHANGES] if everywhere else [self.urlinfo_collection.name, ALL_CHANGES]
+        docs = self.changes_collection.find({"_id" : {"$in" : ids}})
+        return sum(doc["counter"] for doc in docs)
+
+    ################ BACKGROUND JOBS #########################
+
+    def create_background_job(self, kind, params=None, exclusive=False):
+        """Record a new background job for the current collections, returns its id.
+
+        Only one exclusive job of a kind runs on the same collections at a time, the unique exclusive
+        key it holds until it finishes makes that hold across processes. Starting another one raises
+        JobRunningError with the running job's id.
+        """
+
+        now = datetime.utcnow()
+        job_doc = {"kind" : kind, "params" : params or {}, "state" : "running", "progress" : {},
+                   "workspace" : self.workspace_name, "which_collection" : self.which_collection,
+                   "created_at" : now, "heartbeat_at" : now}
+        if not exclusive:
+            return str(self.jobs_collection.insert(job_doc))
+
+        self.jobs_collection.ensure_index("exclusive", unique=True, sparse=True)
+        job_doc["exclusive"] = "%s/%s/%s" % (kind, self.workspace_name, self.which_collection)
+        try:
+            return str(self.jobs_collection.insert(job_doc))
+        except DuplicateKeyError:
+            running = self.jobs_collection.find_one({"exclusive" : job_doc["exclusive"]}, {"_id" : 1})
+            raise JobRunningError(str(running["_id"]) if running else None)
+
+    def update_background_job(self, job_id, **fields):
+        """Set fields on the job, returns the job's cancel_requested field as it was before the update"""
+
+        return self.jobs_collection.find_and_modify({"_id" : ObjectId(job_id)}, {"$set" : fields}, fields={"cancel_requested" : 1})
+
+    def finish_background_job(self, job_id, state, **fields):
+        """Record the final state of a job, which releases its exclusive key"""
+
+        fields.update(state=state, finished_at=datetime.utcnow())
+        self.jobs_collection.update({"_id" : ObjectId(job_id)}, {"$set" : fields, "$unset" : {"exclusive" : ""}})
+
+    def get_background_job(self, job_id):
+        return self.jobs_collection.find_one({"_id" : ObjectId(job_id)})
+
+    def fail_dead_background_jobs(self, dead_after):
+        """Mark running jobs whose heartbeat is more than dead_after seconds old as failed, their
+        process died without recording it. Returns how many there were."""
+
+        now = datetime.utcnow()
+        cutoff = now - timedelta(seconds=dead_after)
+        res = self.jobs_collection.update({"state" : "running", "$or" : [{"heartbeat_at" : {"$lt" : cutoff}},
+                                                                         {"heartbeat_at" : {"$exists" : False}, "created_at" : {"$lt" : cutoff}}]},
+                                          {"$set" : {"state" : "failed", "error" : "The job stopped reporting, its process died",
+                                                     "finished_at" : now},
+                                           "$unset" : {"exclusive" : ""}}, multi=True)
+        return res["n"]
+
+    def cancel_background_job(self, job_id):
+        """Ask a running job to stop, it does at its next progress report. Returns False if it isn't running."""
+
+        res = self.jobs_collection.update({"_id" : ObjectId(job_id), "state" : "running"}, {"$set" : {"cancel_requested" : True}})
+        return res["n"] > 0
+
+    def list_background_jobs(self, kind=None, limit=50):
+        """Jobs run on the current collections (and workspace), newest first"""
 
+        self.jobs_collection.ensure_index([("workspace", pymongo.ASCENDING), ("which_collection", pymongo.ASCENDING), ("created_at", pymongo.DESCENDING)])
+        query = {"workspace" : self.workspace_name, "which_collection" : self.which_collection}
+        if kind:
+            query["kind"] = kind
+        return list(self.jobs_collection.find(query).sort("created_at", pymongo.DESCENDING).limit(limit))
 
     ################ BLURRING #########################
 
@@ -489,6 +1331,7 @@ class MemexMongoUtils(object):
             self.workspace_collection.upsert({"_id" : "_default"}, {'$set' : {"blur_level" : level}})
         else:
             self.workspace_collection.update({"_id" : ObjectId(ws["_id"] )}, {'$set' : {"blur_level" : level}})
+        self.bump_changes(everywhere=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,77 @@
+from memex_mongo_utils import get_client, backfill_search_keys, move_inline_content, ensure_url_indexes, \
+    ensure_host_indexes, ensure_content_indexes, ALL_CHANGES
+
+# (urlinfo, hostinfo, contentinfo) collections not tied to a workspace, the ones of a workspace are
+# named like the first set with "-<workspace>" appended
+COLLECTION_SETS = [("urlinfo", "hostinfo", "contentinfo"),
+                   ("cc-urlinfo", "cc-hostinfo", "cc-contentinfo"),
+                   ("known-urlsinfo", "known-hostsinfo", "known-contentinfo")]
+
+# indexes of older versions that a current index makes redundant
+OBSOLETE_HOST_INDEXES = ["host_score_1"]
+
+
+def collection_sets(db):
+    """(urlinfo, hostinfo, contentinfo) names of every url/host collection pair, missing ones as None.
+    A missing contentinfo is named anyway when its urlinfo exists, the url bodies are moved there.
+    """
+
+    names = set(db.collection_names())
+    workspace_prefix = COLLECTION_SETS[0][1] + "-"
+    sets = list(COLLECTION_SETS)
+    for name in names:
+        if name.startswith(workspace_prefix):
+            workspace = name[len(workspace_prefix):]
+            sets.append(tuple(base + "-" + workspace for base in COLLECTION_SETS[0]))
+
+    return [(url_name if url_name in names else None,
+             host_name if host_name in names else None,
+             content_name if content_name in names or url_name in names else None)
+            for url_name, host_name, content_name in sets]
+
+
+def migrate_indexes(db, url_name, host_name, content_name):
+    """Create the indexes current code relies on in collections made by older versions"""
+
+    if url_name:
+        ensure_url_indexes(db[url_name])
+    if host_name:
+        ensure_host_indexes(db[host_name])
+        indexes = db[host_name].index_information()
+        for index in OBSOLETE_HOST_INDEXES:
+            if index in indexes:
+                db[host_name].drop_index(index)
+    if content_name:
+        ensure_content_indexes(db[content_name])
+
+
+def migrate(address="mongodb", port=27017):
+    """Bring collections and documents stored by older versions up to date. Request handlers only
+    read what this writes, so it runs once before the UI starts serving rather than on the first request.
+    """
+
+    db = get_client(address, port)["MemexHack"]
+
+    changed = 0
+    for url_name, host_name, content_name in collection_sets(db):
+        migrate_indexes(db, url_name, host_name, content_name)
+
+        if host_name:
+            count = backfill_search_keys(db[host_name])
+            if count:
+                print "Added search keys to %d hosts of %s" % (count, host_name)
+            changed += count
+
+        if url_name:
+            count = move_inline_content(db[url_name], db[content_name])
+            if count:
+                print "Moved the page bodies of %d urls of %s to %s" % (count, url_name, content_name)
+
+    # the keys feed the filtered listings, make their cached responses and ETags go stale
+    if changed:
+        db["changes"].update({"_id" : ALL_CHANGES}, {"$inc" : {"counter" : 1}}, upsert=True)
+
+
+if __name__ == "__main__":
+
+    migrate()
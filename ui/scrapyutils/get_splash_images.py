@@ -67,28 +67,35 @@ class SplashGet(object):
         for url_dic in url_dics:
             self.request_and_save(url_dic["url"])
 
+    def _iter_urls_without_screenshot(self):
+        # every url costs a splash render, keep batches small so the cursor doesn't time out in between.
+        # No host order needed, _id order walks the collection without a sort.
+        return self.mmu.iter_urls(sort_by="_id", fields=["url", "host"], query={"screenshot_path" : {"$exists" : False}},
+                                  batch_size=20)
+
     def resolve_images_by_url_match(self, match_term):
-        url_dics = self.mmu.list_all_urls()
-        for url_dic in url_dics:
-            #get only if it doesn't have an existing screenshot            
-            if "screenshot_path" not in url_dic:
-                #!string matching for now, makes more sense as regex
-                if match_term in url_dic["url"]:
-                    self.request_and_save(url_dic["url"])
+        #get only if it doesn't have an existing screenshot
+        for url_dic in self._iter_urls_without_screenshot():
+            #!string matching for now, makes more sense as regex
+            if match_term in url_dic["url"]:
+                self.request_and_save(url_dic["url"])
 
     def resolve_images_by_host_match(self, match_term):
-        url_dics = self.mmu.list_all_urls()
-        for url_dic in url_dics:
-            #get only if it doesn't have an existing screenshot
-            if "screenshot_path" not in url_dic:
-                #!string matching for now, makes more sense as regex
-                if match_term in url_dic["host"]:
-                    self.request_and_save(url_dic["url"])
+        #get only if it doesn't have an existing screenshot
+        for url_dic in self._iter_urls_without_screenshot():
+            #!string matching for now, makes more sense as regex
+            if match_term in url_dic["host"]:
+                self.request_and_save(url_dic["url"])
 
     def get_url_chunks(self, chunk_size):
-        url_dics = self.mmu.list_all_urls()
-        for i in xrange(0, len(url_dics), chunk_size):
-            yield url_dics[i:i+chunk_size]
+        chunk = []
+        for url_dic in self.mmu.iter_urls(sort_by="_id", fields=["url", "host", "screenshot_path"]):
+            chunk.append(url_dic)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
 
 
     """
@@ -1,10 +1,11 @@
 import os
 from flask import Flask
 from flask import render_template, Response, request
-from flask import make_response, redirect, session, url_for
+from flask import make_response, redirect, session, url_for, abort
 from handlers import request_wants_json
-from mongoutils.memex_mongo_utils import MemexMongoUtils
-from handlers import hosts_handler, urls_handler, \
+from mongoutils.memex_mongo_utils import MemexMongoUtils, begin_workspace_scope, end_workspace_scope
+from mongoutils.migrate import migrate
+from handlers import hosts_handler, urls_handler, url_detail_handler, get_collection_by_path, \
 get_job_state_handler, schedule_spider_handler, \
 discovery_handler, mark_interest_handler, get_screenshot_relative_path
 import json
@@ -13,20 +14,17 @@ from handlers import set_score_handler
 from handlers import list_workspace, add_workspace, set_workspace_selected, delete_workspace
 from handlers import list_keyword, save_keyword, schedule_spider_searchengine_handler, list_search_term, save_search_term
 from handlers import add_known_urls_handler
-from handlers import get_score_handler
-import traceback
-try:
-    from handlers import train_and_score_mongo
-except:
-    print "****Warning: Scoring is disabled because: ****"
-    traceback.print_exc()
+from handlers import get_score_handler, rescore_db_handler
 
 from handlers import list_tags, save_tags, search_tags
-from handlers import save_display
+from handlers import save_display, save_displays
 from handlers import get_page_number_for_host
 from handlers import get_blur_level, save_blur_level
+from handlers import start_delete_job, get_job_handler, cancel_job_handler, list_jobs_handler
+from handlers import explain_hosts_filter_handler
 from auth import requires_auth
-from mongoutils.errors import DeletingSelectedWorkspaceError
+from cache import cached_response, response_cache
+from mongoutils.errors import DeletingSelectedWorkspaceError, JobRunningError
 
 from searchengine.pharma.spiders.basesearchengine import BaseSearchEngineSpider
 from searchengine.pharma.spiders.google_com import GoogleComSpider
@@ -35,6 +33,9 @@ server_path = os.path.dirname(os.path.realpath(__file__))
 app = Flask(__name__)
 app.config.from_object('settings')
 from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from pymongo.errors import ExecutionTimeout
+from datetime import datetime
 
 
 class StaticSettings:
@@ -50,8 +51,32 @@ class JSONEncoder(json.JSONEncoder):
     def default(self, o):
         if isinstance(o, ObjectId):
             return str(o)
+        if isinstance(o, datetime):
+            return o.isoformat()
         return json.JSONEncoder.default(self, o)
 
+
+def stream_json(docs):
+    """JSON array response written out a document at a time as docs are read"""
+
+    def generate():
+        yield "["
+        for i, doc in enumerate(docs):
+            yield ("," if i else "") + json.dumps(doc)
+        yield "]"
+
+    return Response(generate(), mimetype="application/json")
+
+
+# every MemexMongoUtils a request builds (cache, handlers, known hosts) shares one workspace lookup
+@app.before_request
+def open_workspace_scope():
+    begin_workspace_scope()
+
+@app.teardown_request
+def close_workspace_scope(exc):
+    end_workspace_scope()
+
 # ui
 @app.route("/discovery")
 #@requires_auth
@@ -83,7 +108,10 @@ def back(page=1):
             redirect_to += "?show-all=true"
 
     # if current_host:
-    page_number = get_page_number_for_host(path, StaticSettings().page_size, current_host, filter_field, filter_regex, show_all)
+    try:
+        page_number = get_page_number_for_host(path, StaticSettings().page_size, current_host, filter_field, filter_regex, show_all)
+    except (ValueError, ExecutionTimeout):
+        page_number = 0
     if page_number > 0 :
         redirect_to += "#page-number=" + str(page_number)
 
@@ -120,13 +148,19 @@ def known_data(page=1):
 # services
 @app.route("/hosts/<page>")
 #@requires_auth
+@cached_response("load_hosts", which_collection="crawl-data")
 def load_hosts(page=1):
 
     filter_field = request.args.get('filter-field')
     filter_regex = request.args.get('filter-regex')
     show_all = request.args.get('show-all')
+    after = request.args.get('after')
 
-    hosts = hosts_handler(page=int(page) + 1, page_size=StaticSettings().page_size, filter_field = filter_field, filter_regex = filter_regex, show_all=show_all)
+    try:
+        hosts = hosts_handler(page=int(page) + 1, page_size=StaticSettings().page_size, filter_field = filter_field, filter_regex = filter_regex, show_all=show_all, after=after)
+    except (ValueError, ExecutionTimeout):
+        # malformed page token, invalid filter regex or one too expensive to run
+        abort(400)
     for host_dic in hosts:
         host_dic["host_hash"] = str(hashlib.md5(host_dic["host"]).hexdigest())
         if "tags" in host_dic:
@@ -137,40 +171,69 @@ def load_hosts(page=1):
 
     return render_template('hosts.html', hosts=hosts, use_cc_data=False, page=page)
 
+@app.route("/api/hosts/explain")
+#@requires_auth
+def explain_hosts_filter():
+
+    filter_field = request.args.get('filter-field', 'host')
+    filter_regex = request.args.get('filter-regex')
+    show_all = request.args.get('show-all')
+    if not filter_regex:
+        abort(400)
+
+    try:
+        explained = explain_hosts_filter_handler(filter_field, filter_regex, show_all=show_all)
+    except (ValueError, ExecutionTimeout):
+        abort(400)
+    return Response(json.dumps(explained, default=str), mimetype="application/json")
+
 @app.route("/cc-hosts/<page>")
 #@requires_auth
+@cached_response("cc_load_hosts", which_collection="cc-crawl-data")
 def cc_load_hosts(page=1):
 
     show_all = request.args.get('show-all')
+    after = request.args.get('after')
 
-    hosts = hosts_handler(page=int(page) + 1, page_size=StaticSettings().page_size, which_collection="cc-crawl-data", show_all=show_all)
+    try:
+        hosts = hosts_handler(page=int(page) + 1, page_size=StaticSettings().page_size, which_collection="cc-crawl-data", show_all=show_all, after=after)
+    except ValueError:
+        abort(400)
 
     if request_wants_json():
         return Response(json.dumps(hosts), mimetype="application/json")
 
-    return render_template('hosts.html', hosts=hosts, which_collection="cc-crawl-data", use_cc_data=True)
+    return render_template('hosts.html', hosts=hosts, which_collection="cc-crawl-data", use_cc_data=True, page=page)
 
 @app.route("/known-hosts/<page>")
 #@requires_auth
+@cached_response("known_load_hosts", which_collection="known-data")
 def known_load_hosts(page=1):
 
     show_all = request.args.get('show-all')
+    after = request.args.get('after')
 
-    hosts = hosts_handler(page=int(page) + 1, page_size=StaticSettings().page_size, which_collection="known-data", show_all=show_all)
+    try:
+        hosts = hosts_handler(page=int(page) + 1, page_size=StaticSettings().page_size, which_collection="known-data", show_all=show_all, after=after)
+    except ValueError:
+        abort(400)
 
     if request_wants_json():
         return Response(json.dumps(hosts), mimetype="application/json")
 
-    return render_template('hosts.html', hosts=hosts, which_collection="known-data", use_known_data=True)
+    return render_template('hosts.html', hosts=hosts, which_collection="known-data", use_known_data=True, page=page)
 
 @app.route("/urls")
 @app.route("/urls/<host>")
 #@requires_auth
+@cached_response("urls", which_collection="crawl-data")
 def urls(host=None):
 
     urls = urls_handler(host)
     if request_wants_json():
-        return Response(json.dumps(urls), mimetype="application/json")
+        return stream_json(urls)
+
+    urls = list(urls)
 
     # !super hacky
     for url_dic in urls:
@@ -186,11 +249,14 @@ def urls(host=None):
 @app.route("/cc-urls")
 @app.route("/cc-urls/<host>")
 #@requires_auth
+@cached_response("cc_urls", which_collection="cc-crawl-data")
 def cc_urls(host=None):
 
-    urls = list(urls_handler(host, which_collection="cc-crawl-data"))
+    urls = urls_handler(host, which_collection="cc-crawl-data")
     if request_wants_json():
-        return Response(json.dumps(urls), mimetype="application/json")
+        return stream_json(urls)
+
+    urls = list(urls)
 
     blur_level = get_blur_level()
 
@@ -200,17 +266,35 @@ def cc_urls(host=None):
 @app.route("/known-urls")
 @app.route("/known-urls/<host>")
 #@requires_auth
+@cached_response("known_urls", which_collection="known-data")
 def known_urls(host=None):
 
-    urls = list(urls_handler(host, which_collection="known-data"))
+    urls = urls_handler(host, which_collection="known-data")
     if request_wants_json():
-        return Response(json.dumps(urls), mimetype="application/json")
+        return stream_json(urls)
+
+    urls = list(urls)
 
     blur_level = get_blur_level()
 
     # change this
     return render_template("urls.html", urls=urls, use_known_data=True, blur_level=blur_level, img_height=StaticSettings().url_img_height, img_width=StaticSettings().url_img_width)
 
+@app.route("/api/url", methods=['GET'])
+#@requires_auth
+def url_detail_api():
+    """All fields of one url, ?url=...[&path=data|cc-data|known-data][&html=true]"""
+
+    url = request.args.get('url')
+    which_collection = get_collection_by_path(request.args.get('path', 'data'))
+    if not url or isinstance(which_collection, Exception):
+        abort(400)
+
+    url_dic = url_detail_handler(url, which_collection=which_collection, return_html=request.args.get('html') == 'true')
+    if url_dic == None:
+        abort(404)
+    return Response(JSONEncoder().encode(url_dic), mimetype="application/json")
+
 @app.route("/add-known", methods = ['GET', 'POST'])
 #@requires_auth
 def add_known_urls():
@@ -273,7 +357,8 @@ def set_score(score):
 @app.route("/api/tags/<term>" , methods=['GET'])
 #@requires_auth
 def api_search_term(term):
-    in_doc = search_tags(term)
+    limit = request.args.get('limit', 20, type=int)
+    in_doc = search_tags(term, limit=limit)
     if in_doc == None:
         return Response("{}", mimetype="application/json")
     else:
@@ -303,6 +388,58 @@ def api_save_display(host):
     save_display(host, displayable)
     return Response("{}", mimetype="application/json")
 
+@app.route("/api/hosts/display", methods=['PUT'])
+#@requires_auth
+def api_save_displays():
+    data = request.json
+    save_displays(data['hosts'], data['display'])
+    return Response("{}", mimetype="application/json")
+
+############# Deleting #############
+@app.route("/api/delete/<by>", methods=['POST'])
+#@requires_auth
+def delete_by_match_api(by):
+    if by not in ("url", "host", "all"):
+        abort(404)
+
+    data = request.json
+    job_id = start_delete_job(data["match"], negative_match=bool(data.get("negative_match")), by=by)
+    return Response(json.dumps({"job_id" : job_id}), mimetype="application/json")
+
+############# Background jobs #############
+@app.route("/api/jobs", methods=['GET'])
+#@requires_auth
+def list_jobs_api():
+    kind = request.args.get('kind')
+    limit = request.args.get('limit', 50, type=int)
+    return Response(JSONEncoder().encode(list_jobs_handler(kind=kind, limit=limit)), mimetype="application/json")
+
+@app.route("/api/jobs/<job_id>", methods=['GET'])
+#@requires_auth
+def get_job_api(job_id):
+    try:
+        job_doc = get_job_handler(job_id)
+    except InvalidId:
+        abort(404)
+    if job_doc == None:
+        abort(404)
+    return Response(JSONEncoder().encode(job_doc), mimetype="application/json")
+
+@app.route("/api/jobs/<job_id>/cancel", methods=['POST'])
+#@requires_auth
+def cancel_job_api(job_id):
+    try:
+        cancelled = cancel_job_handler(job_id)
+    except InvalidId:
+        abort(404)
+    return Response(json.dumps({"cancel_requested" : cancelled}), mimetype="application/json")
+
+############# Response cache #############
+@app.route("/api/cache/stats", methods=['GET'])
+#@requires_auth
+def get_cache_stats_api():
+    return Response(json.dumps(response_cache.stats()), mimetype="application/json")
+
 ############# Workspaces #############
 @app.route("/")
 @app.route("/workspace/" , methods=['GET'])
@@ -313,6 +450,7 @@ def get_workspace_view():
 
 @app.route("/api/workspace/", methods=['GET'])
 #@requires_auth
+@cached_response("get_workspace_api")
 def get_workspace_api():
     in_doc = list_workspace()
     out_doc = JSONEncoder().encode(in_doc)
@@ -359,6 +497,7 @@ def get_keyword_view():
 
 @app.route("/api/keyword/", methods=['GET'])
 #@requires_auth
+@cached_response("get_keyword_api")
 def get_keyword_api():
     in_doc = list_keyword()
     out_doc = JSONEncoder().encode(in_doc)
@@ -402,6 +541,7 @@ def get_search_term_view():
 
 @app.route("/api/searchterm/", methods=['GET'])
 #@requires_auth
+@cached_response("get_search_term_api")
 def get_search_term_api():
     in_doc = list_search_term()
     out_doc = JSONEncoder().encode(in_doc)
@@ -437,17 +577,24 @@ def fetch_search_terms_api():
 def get_scoring_page():
 
     if request.method == "GET":
-        yes_interest_docs, no_interest_docs = get_score_handler()
+        num_yes_interest, num_no_interest = get_score_handler()
 
-        return render_template('score.html', num_yes_interest = len(yes_interest_docs), num_no_interest = len(no_interest_docs))
+        return render_template('score.html', num_yes_interest = num_yes_interest, num_no_interest = num_no_interest)
 
 @app.route("/api/rescore", methods = ["POST"])
 #@requires_auth
 def start_ranker():
 
     if request.method == "POST":
-        train_and_score_mongo()
-        return Response("{}", mimetype="application/json")
+        # {"retrain": false} only scores urls that are new or changed since the last rescore,
+        # {"partial": true} updates a hashing model with the new labels instead of retraining it
+        data = request.get_json(silent=True) or {}
+        try:
+            job_id = rescore_db_handler(retrain=data.get("retrain", True) is not False, partial=bool(data.get("partial")))
+        except JobRunningError as e:
+            return Response(json.dumps({"error" : "A rescore is already running", "job_id" : e.job_id}),
+                            status=409, mimetype="application/json")
+        return Response(json.dumps({"job_id" : job_id}), mimetype="application/json")
 
 
 
@@ -478,14 +625,24 @@ if __name__ == "__main__":
     from tornado.wsgi import WSGIContainer
     from tornado.httpserver import HTTPServer
     from tornado.ioloop import IOLoop
-    from tornado.options import parse_command_line
+    from tornado.options import define, options, parse_command_line
     #from yourapplication import app
 
+    define("port", default=app.config["SERVER_PORT"], type=int, help="port to listen on")
+    define("workers", default=app.config["SERVER_WORKERS"], type=int,
+           help="worker processes serving requests side by side, 0 for one per CPU")
+
     # turns on access.log printing to stdout
     parse_command_line()
+
+    # once before forking, request handlers leave old documents to the migration
+    migrate()
+
+    # WSGIContainer runs one request at a time, so requests are spread over forked workers
+    # sharing the listening socket. Mongo clients are per process (see get_client).
     http_server = HTTPServer(WSGIContainer(app))
-    http_server.listen(8080)
+    http_server.bind(options.port)
+    http_server.start(options.workers)
     IOLoop.instance().start()
     
     #app.run('0.0.0.0', port=80, threaded=True)
-
@@ -2,4 +2,11 @@ INIT_DB_ON_START = False
 MONGO_ADDRESS = "mongodb"
 MONGO_PORT = 27017
 DEBUG = True
-SCREENSHOT_DIR = '/memex-pinterest/ui/static/images/screenshots'
\ No newline at end of file
+SCREENSHOT_DIR = '/memex-pinterest/ui/static/images/screenshots'
+# In-process cache of the JSON/listing responses, see cache.py
+RESPONSE_CACHE_SIZE = 512
+RESPONSE_CACHE_TTL = 30
+
+# Worker processes forked by "python server.py", 0 starts one per CPU. Override with --workers/--port.
+SERVER_WORKERS = 4
+SERVER_PORT = 8080
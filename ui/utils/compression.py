@@ -0,0 +1,33 @@
+import hashlib
+import zlib
+from bson.binary import Binary
+
+# content_encoding marker stored next to compressed page bodies
+HTML_ENCODING = "zlib"
+
+
+def compress_html(html):
+    """Compress a page body for storage, values that are already compressed pass through"""
+
+    if html is None or isinstance(html, Binary):
+        return html
+    if isinstance(html, unicode):
+        html = html.encode("utf8")
+    return Binary(zlib.compress(html))
+
+
+def decompress_html(html):
+    """Page body as unicode, bodies stored uncompressed pass through"""
+
+    if isinstance(html, Binary):
+        return zlib.decompress(html).decode("utf8")
+    return html
+
+
+def html_digest(html):
+    """sha1 of a page body, the same whether or not it is compressed"""
+
+    html = decompress_html(html)
+    if isinstance(html, unicode):
+        html = html.encode("utf8")
+    return hashlib.sha1(html).hexdigest()